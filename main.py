@@ -1,15 +1,19 @@
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 import json
 import asyncio
+import os
+import shutil
+import tempfile
 
 import bcrypt
 from jose import JWTError, jwt
 import uvicorn
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Form, Request, Response
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Form, Request, Response, UploadFile, File
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.templating import Jinja2Templates
@@ -17,13 +21,28 @@ from fastapi.templating import Jinja2Templates
 from contextlib import asynccontextmanager
 
 from logger_config import logger
-from services import (SpeechRecognizer,
+from services import (ANALYSIS_PROMPT_VERSION,
+                      SpeechRecognizer,
                       TextToSpeechPlayer,
                       EnglishAssistant,
                       DataManager,
                       UserManager,
                       UserCreate,
-                      UserResources)
+                      UserResources,
+                      build_exercise_prompt,
+                      exercise_source_text)
+from services_audio import RecognitionBusy
+from services_inference import (ModelRegistry,
+                                InferenceWorker,
+                                InferencePool,
+                                InferenceBusy,
+                                InferenceCancelled,
+                                ResponseCache,
+                                PRIORITY_INTERACTIVE,
+                                PRIORITY_BACKGROUND,
+                                BACKENDS,
+                                plan_llama_resources)
+from services_tts import SpeechSynthesizer, SynthesisBusy, WaveformCache, model_fingerprint, wav_frame
 from services_create_templates import create_templates, update_index_template
 
 SECRET_KEY = "YOUR_SECRET_KEY_HERE"  # В рабочем проекте это должно быть секретным
@@ -77,8 +96,46 @@ INDEX_PATH = BASE_DIR / "templates" / "index.html"
 LOGIN_PATH = BASE_DIR / "templates" / "login.html"
 REGISTER_PATH = BASE_DIR / "templates" / "register.html"
 MODEL_SPEECH_RECOGNIZER = "../models/vosk-model-small-en-us-zamia-0.5"
+SPEECH_WORKERS = 2  # Threads decoding all recognition sessions
+SPEECH_MAX_SESSIONS = 16  # Concurrent /ws/recognize sessions sharing one Vosk model
+SPEECH_VAD = True  # Decode only voiced audio and finalize when the learner stops speaking
+SPEECH_PROFILE = "low_latency"  # Default /ws/recognize profile for browser audio, see RECOGNITION_PROFILES
+# Limit recognition to the expected answer's words in translation exercises. Off by default:
+# the grammar pulls wrong answers towards the expected one. Sessions can opt in with ?constrained=true
+SPEECH_CONSTRAINED = False
+SPEECH_SOURCE = "browser"  # Default /ws/recognize audio source: "browser" (PCM16 over the websocket) or "server" (PyAudio)
+SPEECH_PREWARM_MIC = False  # Open the server microphone at startup instead of on the first source=server session
 MODEL_SPEECH_PLAYER = BASE_DIR / "lang_models" / "v3_1_ru.pt"
+TTS_WORKERS = 2  # Concurrent syntheses, each worker with its own copy of the Silero model
+TTS_THREAD_BUDGET = 4  # torch threads for all TTS workers together
+TTS_QUEUE_DEPTH = 64  # Sentences waiting for synthesis before we answer "busy"
+TTS_CACHE_DIR = BASE_DIR / "data" / "tts_cache"
+TTS_CACHE_MEMORY_MB = 64  # Recently spoken waveforms kept in RAM
+TTS_CACHE_DISK_MB = 1024  # int16 WAV files kept on disk
 MODEL_ENGLISH_ASSISTANT = "../models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf"
+# "llama_cpp", or "fake" to benchmark the web layer without a GGUF: LLM_BACKEND=fake uvicorn main:app
+LLM_BACKEND = os.getenv("LLM_BACKEND", "llama_cpp")
+LLM_FAKE_LATENCY_MS = 200  # Fake backend: time before the first token
+LLM_FAKE_TOKENS_PER_SECOND = 20  # Fake backend: decode rate
+LLM_MEMORY_BUDGET_MB = 12 * 1024  # Upper bound for all resident GGUF models
+LLM_QUEUE_DEPTH = 16  # Requests waiting for the inference worker before we answer "busy"
+LLM_REQUEST_TIMEOUT = 120  # Seconds
+LLM_N_CTX = 4096  # Wanted context; the startup plan shrinks it to fit the memory budget
+LLM_N_GPU_LAYERS = 50  # Ignored by CPU-only llama.cpp builds
+# Saved system-prompt states per llama context; one Llama 3 state is ~300 MiB, mostly logits
+LLM_PREFIX_CACHE_MB = 1024
+LLM_MAX_BATCH_SIZE = 2  # Upper bound for concurrent sequences, each in its own llama context
+LLM_WORKER_PROCESSES = 0  # >0: run inference in up to this many processes sharing the mmap'd GGUF
+# Speculative decoding: the draft model must share the main model's tokenizer
+LLM_DRAFT_ENABLED = False
+LLM_DRAFT_MODEL = "../models/Llama-3.2-1B-Instruct-Q8_0.gguf"
+LLM_DRAFT_TOKENS = 4  # Lookahead proposed per verification step
+LLM_MAX_WAIT_MS = 200  # How long a request may wait for a busy slot before another one is opened
+ANALYSIS_CACHE_PATH = BASE_DIR / "data" / "cache.db"
+EXERCISE_DB_PATH = BASE_DIR / "data" / "data.db"
+# The fake backend keeps its translations and analyses here, emptied at every start, so
+# canned replies never reach learners and benchmarks do not measure old cache hits
+FAKE_BACKEND_DATA_DIR = BASE_DIR / "data" / "fake_backend"
 TEMPLATES_DIR = BASE_DIR / "templates"
 
 # Let's create directories if they don't exist yet.
@@ -86,20 +143,67 @@ TEMPLATES_DIR.mkdir(exist_ok=True)
 
 #Create a resource and user manager
 user_resources = UserResources()
+if LLM_BACKEND == "fake":
+    llm_backend = partial(BACKENDS["fake"],
+                          latency_ms=LLM_FAKE_LATENCY_MS,
+                          tokens_per_second=LLM_FAKE_TOKENS_PER_SECOND)
+    shutil.rmtree(FAKE_BACKEND_DATA_DIR, ignore_errors=True)
+    FAKE_BACKEND_DATA_DIR.mkdir(parents=True)
+    ANALYSIS_CACHE_PATH = FAKE_BACKEND_DATA_DIR / "cache.db"
+    EXERCISE_DB_PATH = FAKE_BACKEND_DATA_DIR / "data.db"
+else:
+    llm_backend = BACKENDS[LLM_BACKEND]
+model_registry = ModelRegistry(memory_budget_mb=LLM_MEMORY_BUDGET_MB, backend=llm_backend)
 user_manager = UserManager(BASE_DIR / "data")
+# Analyses are only reused for the same backend, model files and prompts
+analysis_cache = ResponseCache(ANALYSIS_CACHE_PATH, identity=json.dumps([
+    LLM_BACKEND,
+    model_fingerprint(MODEL_ENGLISH_ASSISTANT),
+    model_fingerprint(LLM_DRAFT_MODEL) if LLM_DRAFT_ENABLED and LLM_BACKEND == "llama_cpp" else None,
+    ANALYSIS_PROMPT_VERSION,
+]))
+tts_cache = WaveformCache(TTS_CACHE_DIR, MODEL_SPEECH_PLAYER,
+                          max_memory_mb=TTS_CACHE_MEMORY_MB,
+                          max_disk_mb=TTS_CACHE_DISK_MB)
 data_manager = None
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global tts_player, speech_recognizer, english_assistant, data_manager
+    global tts_player, speech_synthesizer, speech_recognizer, english_assistant, inference_worker, data_manager
 
-    tts_player = TextToSpeechPlayer(MODEL_SPEECH_PLAYER)
-    speech_recognizer = SpeechRecognizer(MODEL_SPEECH_RECOGNIZER)
-    english_assistant = EnglishAssistant(MODEL_ENGLISH_ASSISTANT)
-    data_manager = DataManager(data_folder=BASE_DIR /"data" )
+    # Speech models are optional and independent: the LLM endpoints run without them
+    # (e.g. benchmarks with the fake backend), and a broken TTS model keeps recognition
+    try:
+        speech_synthesizer = SpeechSynthesizer(MODEL_SPEECH_PLAYER,
+                                               cache=tts_cache,
+                                               workers=TTS_WORKERS,
+                                               thread_budget=TTS_THREAD_BUDGET,
+                                               max_queue=TTS_QUEUE_DEPTH)
+        tts_player = TextToSpeechPlayer(speech_synthesizer)
+    except Exception as e:
+        logger.warning(f"Speech synthesis unavailable: {e}")
+    try:
+        speech_recognizer = create_speech_recognizer()
+    except Exception as e:
+        logger.warning(f"Speech recognition unavailable: {e}")
+    if speech_recognizer and SPEECH_PREWARM_MIC:
+        try:
+            speech_recognizer.start_microphone()
+        except OSError as e:
+            logger.warning(f"Server microphone unavailable: {e}")
+    inference_worker = create_inference_worker()
+    data_manager = DataManager(db_path=str(EXERCISE_DB_PATH), data_folder=BASE_DIR /"data" )
     yield
     if tts_player:
         tts_player.stop()
+    if speech_synthesizer:
+        speech_synthesizer.close()
+    if speech_recognizer:
+        speech_recognizer.close()
+    inference_worker.stop()
+    if english_assistant:
+        english_assistant.close()
+    model_registry.unload_all()
 
     for user_id in list(user_resources.resources.keys()):
         user_resources.cleanup_resources(user_id)
@@ -229,10 +333,84 @@ async def get_current_user_from_cookie(request: Request):
         )
 # Global instances
 tts_player = None
+speech_synthesizer = None
 speech_recognizer = None
 english_assistant = None
+inference_worker = None
 data_manager = None
 
+llama_plan = None
+
+def get_llama_plan():
+    """Sizes n_ctx, threads, batch and instances from the machine, once."""
+    global llama_plan
+    if llama_plan is None:
+        llama_plan = plan_llama_resources(MODEL_ENGLISH_ASSISTANT,
+                                          memory_budget_mb=LLM_MEMORY_BUDGET_MB,
+                                          max_instances=LLM_WORKER_PROCESSES or LLM_MAX_BATCH_SIZE,
+                                          n_ctx=LLM_N_CTX,
+                                          n_gpu_layers=LLM_N_GPU_LAYERS,
+                                          prefix_cache_mb=LLM_PREFIX_CACHE_MB,
+                                          draft_model_path=LLM_DRAFT_MODEL if draft_enabled() else None)
+    return llama_plan
+
+def draft_enabled():
+    return LLM_DRAFT_ENABLED and LLM_BACKEND == "llama_cpp"
+
+def assistant_params():
+    params = dict(get_llama_plan().llama_params(), prefix_cache_mb=LLM_PREFIX_CACHE_MB)
+    if draft_enabled():
+        params.update(draft_model_path=LLM_DRAFT_MODEL, draft_tokens=LLM_DRAFT_TOKENS)
+    return params
+
+def create_speech_recognizer():
+    """One Vosk model for all /ws/recognize sessions."""
+    return SpeechRecognizer(MODEL_SPEECH_RECOGNIZER,
+                            workers=SPEECH_WORKERS,
+                            max_sessions=SPEECH_MAX_SESSIONS,
+                            vad=SPEECH_VAD)
+
+def create_english_assistant(replica=0):
+    return EnglishAssistant(MODEL_ENGLISH_ASSISTANT,
+                            registry=model_registry,
+                            replica=replica,
+                            **assistant_params())
+
+def get_english_assistant():
+    """Returns the process-wide assistant; its model is shared by all users."""
+    global english_assistant
+    if english_assistant is None:
+        english_assistant = create_english_assistant()
+    return english_assistant
+
+def create_inference_worker():
+    if LLM_WORKER_PROCESSES:
+        # Each process loads its own assistant; the web process holds no model
+        worker = InferencePool(
+            partial(EnglishAssistant, MODEL_ENGLISH_ASSISTANT, backend=llm_backend, **assistant_params()),
+            processes=get_llama_plan().n_instances,
+            max_queue=LLM_QUEUE_DEPTH,
+            timeout=LLM_REQUEST_TIMEOUT
+        )
+    else:
+        worker = InferenceWorker(
+            get_english_assistant(),
+            max_queue=LLM_QUEUE_DEPTH,
+            timeout=LLM_REQUEST_TIMEOUT,
+            assistant_factory=create_english_assistant,
+            max_batch_size=get_llama_plan().n_instances,
+            max_wait_ms=LLM_MAX_WAIT_MS
+        )
+    worker.start()
+    return worker
+
+def get_inference_worker():
+    """Returns the scheduler that runs all LLM calls off the event loop."""
+    global inference_worker
+    if inference_worker is None:
+        inference_worker = create_inference_worker()
+    return inference_worker
+
 @app.get("/", response_class=HTMLResponse)
 async def get(request: Request):
     try:
@@ -260,6 +438,8 @@ async def save_settings(request: Request):
         }
         
         success = user_manager.update_user_settings(user.id, settings)
+        # The prefetched exercise was made for the old settings
+        user_resources.get_or_create_resources(user.id)["session"].discard_prefetch()
         if success:
             return {"status": "success", "message": "Settings saved successfully"}
         else:
@@ -275,19 +455,52 @@ async def get_settings(request: Request):
     except HTTPException:
         return {"settings": {}}
 
+def get_expected_answer(user):
+    """Expected answer of the learner's current exercise, if any."""
+    return user_resources.get_or_create_resources(user.id)["session"].expected_answer or None
+
 @app.websocket("/ws/recognize")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, source: str = SPEECH_SOURCE, profile: str = SPEECH_PROFILE,
+                             constrained: bool = SPEECH_CONSTRAINED):
+    """source=browser: the page streams PCM16 frames from getUserMedia,
+    source=server: audio comes from the server's own microphone.
+    profile=low_latency|default picks the frame size and partial-result rate
+    constrained=true limits recognition to the expected answer's words"""
     global speech_recognizer
     
     await websocket.accept()
+
+    # Only learners may hold one of the shared recognition sessions
+    try:
+        user = await get_current_user_from_cookie(websocket)
+    except HTTPException:
+        await websocket.send_json({"type": "error", "text": "Not authenticated"})
+        await websocket.close(code=1008)  # Policy violation
+        return
     
     if speech_recognizer is None:
         try:
-            speech_recognizer = SpeechRecognizer(MODEL_SPEECH_RECOGNIZER)
+            speech_recognizer = create_speech_recognizer()
         except Exception as e:
             await websocket.send_json({"type": "error", "text": f"Initialization error: {str(e)}"})
             await websocket.close()
             return
+
+    expected_answer = get_expected_answer(user) if constrained else None
+
+    if source == "browser":
+        try:
+            await speech_recognizer.recognize_client(websocket, profile, expected_answer)
+            await websocket.close()
+        except RecognitionBusy as e:
+            logger.warning(f"Recognition rejected: {e}")
+            await websocket.send_json({"type": "error", "text": "Сервер распознавания занят, попробуйте позже"})
+            await websocket.close(code=1013)  # Try again later
+        except (WebSocketDisconnect, RuntimeError):
+            logger.info("WebSocket disconnected")
+        except Exception as e:
+            logger.error(f"Error in websocket endpoint: {e}")
+        return
     
     try:
         # Stop any existing recognition process
@@ -295,7 +508,7 @@ async def websocket_endpoint(websocket: WebSocket):
             speech_recognizer.stop()
         
         # Start recognition in a task
-        recognition_task = asyncio.create_task(speech_recognizer.recognize_stream(websocket))
+        recognition_task = asyncio.create_task(speech_recognizer.recognize_stream(websocket, expected_answer))
         
         # Listen for stop messages from client
         while True:
@@ -324,31 +537,190 @@ async def websocket_endpoint(websocket: WebSocket):
         if speech_recognizer:
             speech_recognizer.stop()
 
+@app.post("/transcribe")
+async def transcribe(request: Request, files: List[UploadFile] = File(...)):
+    """Offline transcription of recorded answers (WAV/FLAC) with word timings."""
+    await get_current_user_from_cookie(request)
+    if speech_recognizer is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Speech recognition model is not loaded")
+
+    async def transcribe_upload(upload):
+        # Spool to disk so the recognizer can stream it chunk by chunk
+        suffix = Path(upload.filename or "").suffix or ".wav"
+        tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        try:
+            with tmp:
+                await asyncio.to_thread(shutil.copyfileobj, upload.file, tmp)
+            result = await speech_recognizer.transcribe(tmp.name)
+            result["file"] = upload.filename
+            return result
+        except Exception as e:
+            logger.error(f"Transcription of {upload.filename} failed: {e}")
+            return {"file": upload.filename, "error": str(e)}
+        finally:
+            os.unlink(tmp.name)
+
+    return {"results": await asyncio.gather(*(transcribe_upload(upload) for upload in files))}
+
+SECTION_TITLES = {
+    "verdict": "Verdict",
+    "grammar": "Grammar",
+    "pronunciation": "Pronunciation",
+    "alternatives": "Alternatives",
+}
+
 @app.post("/get_anal")
 async def get_anal(
     request: Request,
     text: str = Form(...),
     native_lang: str = Form(...),
-    explanations: list = Form(None)
+    explanations: list = Form(None),
+    structured: bool = Form(False)
 ):
+    """Answer analysis; with structured=true also returns it split into sections."""
     try:
         user = await get_current_user_from_cookie(request)
-        resources = user_resources.get_or_create_resources(user.id)
-        
-        if not resources["english_assistant"]:
-            resources["english_assistant"] = EnglishAssistant(MODEL_ENGLISH_ASSISTANT)
+        session = user_resources.get_or_create_resources(user.id)["session"]
         
-        english_assistant = resources["english_assistant"]
-        description = english_assistant.process_request(
-            text,
-            native_lang,
-            explanations
-        )
+        if structured:
+            cache_key = analysis_cache.make_key(session.question, text, native_lang, explanations, "sections")
+            cached = analysis_cache.get(cache_key)
+            if cached is not None:
+                sections = json.loads(cached)
+            else:
+                sections = await get_inference_worker().submit(
+                    "process_structured",
+                    text,
+                    native_lang,
+                    explanations,
+                    session.question,
+                    request=request
+                )
+                analysis_cache.put(cache_key, json.dumps(sections, ensure_ascii=False))
+            description = "\n".join(f"{SECTION_TITLES[name]}: {value}"
+                                    for name, value in sections.items() if value)
+            return {"text": description, "sections": sections}
+
+        cache_key = analysis_cache.make_key(session.question, text, native_lang, explanations)
+        description = analysis_cache.get(cache_key)
+        if description is None:
+            description = await get_inference_worker().submit(
+                "process_request",
+                text,
+                native_lang,
+                explanations,
+                session.question,
+                request=request
+            )
+            analysis_cache.put(cache_key, description)
         
         return {"text": f"{description}"}
     except HTTPException:
         return {"text": "Authentication error. Please log in again."}
+    except InferenceBusy:
+        return {"text": "The assistant is busy right now. Please try again in a moment."}
+    except asyncio.TimeoutError:
+        return {"text": "The assistant took too long to answer. Please try again."}
+    except InferenceCancelled:
+        return {"text": ""}
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """Formats one Server-Sent Event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
+@app.post("/get_anal_stream")
+async def get_anal_stream(
+    request: Request,
+    text: str = Form(...),
+    native_lang: str = Form(...),
+    explanations: list = Form(None)
+):
+    """Streaming variant of /get_anal: pushes tokens to the browser as SSE."""
+    try:
+        user = await get_current_user_from_cookie(request)
+    except HTTPException:
+        async def auth_error():
+            yield sse_event({"text": "Authentication error. Please log in again."}, "error")
+        return StreamingResponse(auth_error(), media_type="text/event-stream")
+
+    session = user_resources.get_or_create_resources(user.id)["session"]
+    cache_key = analysis_cache.make_key(session.question, text, native_lang, explanations)
+
+    async def events():
+        cached = analysis_cache.get(cache_key)
+        if cached is not None:
+            yield sse_event({"token": cached})
+            yield sse_event({}, "done")
+            return
+        try:
+            tokens = []
+            async for token in get_inference_worker().stream(
+                "stream_request",
+                text,
+                native_lang,
+                explanations,
+                session.question,
+                request=request
+            ):
+                tokens.append(token)
+                yield sse_event({"token": token})
+            analysis_cache.put(cache_key, "".join(tokens).strip())
+            yield sse_event({}, "done")
+        except InferenceBusy:
+            yield sse_event({"text": "The assistant is busy right now. Please try again in a moment."}, "error")
+        except asyncio.TimeoutError:
+            yield sse_event({"text": "The assistant took too long to answer. Please try again."}, "error")
+        except InferenceCancelled:
+            return
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def get_data_manager():
+    global data_manager
+    if data_manager is None:
+        data_manager = DataManager(db_path=str(EXERCISE_DB_PATH), data_folder=BASE_DIR / "data")
+    return data_manager
+
+async def prepare_exercise(difficulty, native_lang, interaction_type, request=None,
+                           priority=PRIORITY_INTERACTIVE):
+    """Takes the next entry and renders its prompt: (entry_id, prompt, expected answer) or None.
+    Only translation exercises have an expected answer, the others get ""."""
+    entry = get_data_manager().get_next(interaction_type, difficulty)
+    if entry is None:
+        return None
+    entry_id, text = entry
+    try:
+        # Translations are precomputed by pretranslate.py; the LLM only covers misses
+        translation = get_data_manager().get_translation(entry_id, native_lang)
+        if translation is None:
+            response = await get_inference_worker().submit(
+                "get_native_responce",
+                exercise_source_text(text),
+                native_lang,
+                request=request,
+                priority=priority
+            )
+            translation = response["choices"][0]["message"]["content"].strip()
+            get_data_manager().save_translation(entry_id, native_lang, translation)
+    except BaseException:
+        # Nobody will see this entry, give it back
+        get_data_manager().release_entry(entry_id)
+        raise
+    expected_answer = exercise_source_text(text) if interaction_type == "translation" else ""
+    return entry_id, build_exercise_prompt(interaction_type, native_lang, translation), expected_answer
+
+def start_prefetch(session, settings_key):
+    """Prepares the learner's next exercise while they answer the current one."""
+    session.start_prefetch(
+        settings_key,
+        prepare_exercise(*settings_key, priority=PRIORITY_BACKGROUND),
+        on_discard=lambda exercise: get_data_manager().release_entry(exercise[0])
+    )
 
 @app.post("/process")
 async def process_text(
@@ -359,38 +731,19 @@ async def process_text(
 ):
     try:
         user = await get_current_user_from_cookie(request)
-        resources = user_resources.get_or_create_resources(user.id)
-        
-        tr_dic = {
-            "Russian": "переведи на английский следующую фразу: ",
-            "Ukrainian": "переклади англійською наступну фразу: ",
-            "French": "traduisez la phrase suivante en anglais: "
-        }
-        qu_dic = {
-            "Russian": "дай свой ответ на следующий вопрос: ",
-            "Ukrainian": "дай свою відповідь на наступне запитання: ",
-            "French": "donnez votre réponse à la question suivante: "
-        }
-        
-        global data_manager
-        if data_manager is None:
-            data_manager = DataManager(data_folder=BASE_DIR / "data")
-        
-        text_to_translate = data_manager.get_next_entry(interaction_type, difficulty)
-        text_to_translate = text_to_translate.rstrip('?')
-        
-        if not resources["english_assistant"]:
-            resources["english_assistant"] = EnglishAssistant(MODEL_ENGLISH_ASSISTANT)
+        session = user_resources.get_or_create_resources(user.id)["session"]
+        settings_key = (difficulty, native_lang, interaction_type)
         
-        english_assistant = resources["english_assistant"]
-        response = english_assistant.get_native_responce(text_to_translate, native_lang)
-        
-        if interaction_type == "translation":
-            result = tr_dic[native_lang] + response["choices"][0]["message"]["content"].strip()
-        else: 
-            result = qu_dic[native_lang] + response["choices"][0]["message"]["content"].strip() + "?"
-
-        english_assistant.question = result
+        exercise = await session.take_prefetch(settings_key)
+        if exercise is None:
+            exercise = await prepare_exercise(*settings_key, request=request)
+        if exercise is None:
+            return {"response": "There are no more exercises for this level."}
+        _, result, expected_answer = exercise
+
+        session.question = result
+        session.expected_answer = expected_answer
+        start_prefetch(session, settings_key)
         
         user_manager.update_user_settings(user.id, {
             "nativeLanguage": native_lang,
@@ -401,12 +754,29 @@ async def process_text(
         return {"response": result}
     except HTTPException:
         return {"response": "Authentication error. Please log in again."}
+    except InferenceBusy:
+        return {"response": "The assistant is busy right now. Please try again in a moment."}
+    except asyncio.TimeoutError:
+        return {"response": "The assistant took too long to answer. Please try again."}
+    except InferenceCancelled:
+        return {"response": ""}
+
+@app.get("/stats")
+async def stats():
+    """Runtime counters of the shared inference resources."""
+    return {
+        "models": model_registry.stats(),
+        "inference": inference_worker.stats() if inference_worker else None,
+        "analysis_cache": analysis_cache.stats(),
+        "speech": speech_recognizer.stats() if speech_recognizer else None,
+        "tts": speech_synthesizer.stats() if speech_synthesizer else None,
+        "tts_cache": tts_cache.stats(),
+    }
 
 @app.post("/speak_text")
 async def speak_text(request: Request):
     try:
-        user = await get_current_user_from_cookie(request)
-        resources = user_resources.get_or_create_resources(user.id)
+        await get_current_user_from_cookie(request)
         
         data = await request.json()
         text = data.get("text", "")
@@ -414,10 +784,9 @@ async def speak_text(request: Request):
         if not text:
             return {"status": "error", "message": "Текст не предоставлен"}
         
-        if not resources["tts_player"]:
-            resources["tts_player"] = TextToSpeechPlayer(MODEL_SPEECH_PLAYER)
+        if not tts_player:
+            return {"status": "error", "message": "Модель озвучивания не загружена"}
         
-        tts_player = resources["tts_player"]
         tts_player.say(text)
         
         return {"status": "success", "message": "Текст отправлен на озвучивание"}
@@ -425,6 +794,41 @@ async def speak_text(request: Request):
         return {"status": "error", "message": "Authentication error. Please log in again."}
     except Exception as e:
         return {"status": "error", "message": f"Ошибка инициализации или озвучивания: {e}"}
+
+@app.post("/speak_stream")
+async def speak_stream(request: Request):
+    """Speech for the browser instead of the server's speakers: one WAV per
+    sentence, each as a 4-byte big-endian length followed by the file.
+    A zero length means synthesis stayed overloaded and the speech was cut short."""
+    user = await get_current_user_from_cookie(request)
+    data = await request.json()
+    text = data.get("text", "")
+    if not text:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Текст не предоставлен")
+    if speech_synthesizer is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Модель озвучивания не загружена")
+    stream = speech_synthesizer.stream_wav(text, user.id)
+    try:
+        first = await stream.__anext__()  # Surfaces "busy" as a status code, not a broken stream
+    except StopAsyncIteration:
+        first = None
+    except SynthesisBusy:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Синтез речи перегружен, попробуйте позже")
+
+    async def frames():
+        try:
+            if first is not None:
+                yield wav_frame(first)
+            async for wav in stream:
+                if await request.is_disconnected():
+                    break
+                yield wav_frame(wav)
+        finally:
+            await stream.aclose()  # Cancels the sentence queued ahead
+
+    return StreamingResponse(frames(), media_type="application/octet-stream")
     
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,80 @@
+"""Fills the TTS cache with the spoken exercise prompts.
+
+Builds the prompt /process shows for every translated entry, splits it the way
+/speak_stream does and synthesizes each sentence that is not on disk yet, so
+standard exercises are spoken without running the Silero model. Run it after
+pretranslate.py; the database is opened without a refresh.
+
+    python presynthesize.py --languages Russian French --workers 4
+"""
+import argparse
+from pathlib import Path
+
+import torch
+
+from logger_config import logger
+from services import DataManager, NATIVE_LANGUAGES, build_exercise_prompt
+from services_batch import default_workers, process_map
+from services_tts import WaveformCache, load_tts_model, split_sentences, to_int16
+
+BASE_DIR = Path(__file__).resolve().parent
+MODEL_SPEECH_PLAYER = BASE_DIR / "lang_models" / "v3_1_ru.pt"
+TTS_CACHE_DIR = BASE_DIR / "data" / "tts_cache"
+
+def _load_synthesis(model_path, cache_dir, max_disk_mb, n_threads):
+    torch.set_num_threads(n_threads)
+    return (load_tts_model(model_path),
+            WaveformCache(cache_dir, model_path, max_memory_mb=0, max_disk_mb=max_disk_mb))
+
+def _synthesize(synthesis, job):
+    model, cache = synthesis
+    text, speaker, sample_rate = job
+    audio = to_int16(model.apply_tts(text=text, speaker=speaker, sample_rate=sample_rate))
+    cache.put(cache.key(text, speaker, sample_rate), audio, sample_rate)
+    return len(audio) / sample_rate
+
+def collect_sentences(data_manager, languages):
+    """Unique prompt sentences over all translated entries, in first-seen order."""
+    sentences = {}
+    for lang in languages:
+        for _, entry_type, translation in data_manager.get_translated(lang):
+            for sentence in split_sentences(build_exercise_prompt(entry_type, lang, translation)):
+                sentences.setdefault(sentence, None)
+    return list(sentences)
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthesize exercise prompts into the TTS cache")
+    parser.add_argument("--model", default=str(MODEL_SPEECH_PLAYER))
+    parser.add_argument("--cache-dir", default=str(TTS_CACHE_DIR))
+    parser.add_argument("--languages", nargs="+", default=list(NATIVE_LANGUAGES), choices=NATIVE_LANGUAGES)
+    parser.add_argument("--speaker", default="kseniya")
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--threads", type=int, default=2, help="torch threads per worker")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="synthesizing processes, each with its own Silero model")
+    parser.add_argument("--max-disk-mb", type=int, default=1024,
+                        help="cache size limit, as TTS_CACHE_DISK_MB in main.py; raise both for large exercise banks")
+    args = parser.parse_args()
+
+    # No refresh: the server may be running on the same database
+    data_manager = DataManager(db_path=str(BASE_DIR / "data" / "data.db"), data_folder=BASE_DIR / "data",
+                               refresh=False)
+    cache = WaveformCache(args.cache_dir, args.model, max_memory_mb=0, max_disk_mb=args.max_disk_mb)
+    sentences = collect_sentences(data_manager, args.languages)
+    jobs = [(sentence, args.speaker, args.sample_rate) for sentence in sentences
+            if not cache.path(cache.key(sentence, args.speaker, args.sample_rate)).exists()]
+    logger.info(f"{len(sentences) - len(jobs)} of {len(sentences)} prompt sentences already synthesized")
+    if not jobs:
+        return
+
+    workers = args.workers or default_workers(args.threads)
+    logger.info(f"Synthesizing {len(jobs)} sentences with {workers} workers x {args.threads} threads")
+    audio_seconds = 0.0
+    for seconds in process_map(_synthesize, jobs, _load_synthesis,
+                               (args.model, args.cache_dir, args.max_disk_mb, args.threads),
+                               workers=workers, progress="sentences synthesized", log_every=50):
+        audio_seconds += seconds
+    logger.info(f"{audio_seconds / 60:.1f} min of audio added to {args.cache_dir}")
+
+if __name__ == "__main__":
+    main()
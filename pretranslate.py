@@ -0,0 +1,57 @@
+"""Pre-translates the exercise bank into every native language.
+
+Stores an LLM translation of each entry in DataManager's `translations` table,
+so /process can serve exercises without a model call. Entries that already
+have a translation are skipped. The worker processes mmap the same GGUF.
+
+The database is opened without a refresh, so this can run next to the server;
+start the server once beforehand so the entries exist.
+
+    python pretranslate.py --languages Russian French --workers 4
+"""
+import argparse
+from pathlib import Path
+
+from logger_config import logger
+from services import DataManager, EnglishAssistant, NATIVE_LANGUAGES, exercise_source_text
+from services_batch import default_workers, process_map
+
+BASE_DIR = Path(__file__).resolve().parent
+MODEL_ENGLISH_ASSISTANT = "../models/Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf"
+
+def _load_assistant(model_path, n_ctx, n_threads):
+    return EnglishAssistant(model_path, n_ctx=n_ctx, n_threads=n_threads)
+
+def _translate(assistant, job):
+    entry_id, native_lang, text = job
+    response = assistant.get_native_responce(exercise_source_text(text), native_lang)
+    return entry_id, native_lang, response["choices"][0]["message"]["content"].strip()
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-translate exercises for each native language")
+    parser.add_argument("--model", default=MODEL_ENGLISH_ASSISTANT)
+    parser.add_argument("--languages", nargs="+", default=list(NATIVE_LANGUAGES), choices=NATIVE_LANGUAGES)
+    parser.add_argument("--threads", type=int, default=2, help="llama.cpp threads per worker")
+    parser.add_argument("--workers", type=int, default=None, help="translating processes (default: cores / threads)")
+    parser.add_argument("--n-ctx", type=int, default=1024)
+    args = parser.parse_args()
+
+    # No refresh: the server may be running on the same database
+    data_manager = DataManager(db_path=str(BASE_DIR / "data" / "data.db"), data_folder=BASE_DIR / "data",
+                               refresh=False)
+    jobs = [(entry_id, lang, text)
+            for lang in args.languages
+            for entry_id, text in data_manager.get_untranslated(lang)]
+    if not jobs:
+        logger.info("All entries are already translated.")
+        return
+
+    workers = args.workers or default_workers(args.threads)
+    logger.info(f"Translating {len(jobs)} entries with {workers} workers x {args.threads} threads")
+    for entry_id, lang, translation in process_map(_translate, jobs, _load_assistant,
+                                                   (args.model, args.n_ctx, args.threads),
+                                                   workers=workers, progress="translations stored"):
+        data_manager.save_translation(entry_id, lang, translation)
+
+if __name__ == "__main__":
+    main()
@@ -3,122 +3,191 @@ import queue
 import asyncio
 import uuid
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from threading import Thread
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 
-import pyaudio
 import sounddevice as sd
-import torch
-import torch.package
 from vosk import Model, KaldiRecognizer
-from llama_cpp import Llama
 from pydantic import BaseModel
 
 from logger_config import logger
+from services_audio import (RECOGNITION_PROFILES,
+                           MicrophoneCapture,
+                           RecognitionPool,
+                           RecognitionSession,
+                           VadGate,
+                           answer_grammar,
+                           transcribe_file)
+from services_inference import (DRAFT_KV_BYTES_PER_TOKEN,
+                                ModelRegistry,
+                                PrefixStateCache,
+                                SmallModelDraft,
+                                analysis_sections,
+                                chars_per_token,
+                                salvage_sections,
+                                sections_grammar,
+                                sections_max_tokens)
+from llama_cpp import Llama, LlamaGrammar
 import bcrypt
 
 class SpeechRecognizer:
-    """ !!!!!!!Class for converting speech to text!!!!!!!!!!!!!!"""
-    def __init__(self, model_path, sample_rate=16000, frame_size=4000):
+    """ !!!!!!!Class for converting speech to text!!!!!!!!!!!!!!
+
+    The Vosk Model is loaded once and shared read-only; every websocket gets
+    its own KaldiRecognizer (a RecognitionSession) and a fixed pool of threads
+    decodes all sessions in turn, skipping silence via a VadGate. The server
+    microphone stays open between sessions (MicrophoneCapture). Capture and
+    Kaldi never run on the event loop, which only does websocket I/O.
+    """
+    def __init__(self, model_path, sample_rate=16000, frame_size=4000, buffer_seconds=5,
+                 workers=2, max_sessions=16, vad=True, partial_interval_ms=0):
         self.model_path = Path(model_path)
         if not self.model_path.exists():
             raise FileNotFoundError(f"Model file not found: {model_path}")
         self.sample_rate = sample_rate
         self.frame_size = frame_size
+        self.partial_interval_ms = partial_interval_ms
+        self.buffer_bytes = sample_rate * 2 * buffer_seconds  # 16-bit mono
+        self.vad = vad  # Skip silence and finalize on end of utterance
         self.model = Model(str(model_path))
-        self.audio = pyaudio.PyAudio()
-        self.stream = None
-        self.is_running = False
+        self.pool = RecognitionPool(workers=workers, max_sessions=max_sessions)
+        self.batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe")
+        self.microphone = MicrophoneCapture(sample_rate)
+
+    @property
+    def is_running(self):
+        return self.microphone.attached
+
+    def start_microphone(self):
+        """Opens the server microphone ahead of the first session; it then stays open."""
+        self.microphone.start()
+
+    def open_session(self, results, profile=None, expected_answer=None):
+        """Registers a new session whose results go to the asyncio queue `results`.
+        `profile` names a RECOGNITION_PROFILES entry; by default the recognizer's
+        own frame size and partial interval are used. With `expected_answer`
+        the recognizer is limited to its words and falls back to the open
+        vocabulary on doubtful results.
+        Raises RecognitionBusy when max_sessions are already running."""
+        loop = asyncio.get_running_loop()
+        emit = lambda message: loop.call_soon_threadsafe(results.put_nowait, message)
+        if profile in RECOGNITION_PROFILES:
+            frame_size, partial_interval_ms = RECOGNITION_PROFILES[profile]
+        else:
+            frame_size, partial_interval_ms = self.frame_size, self.partial_interval_ms
+        fallback = None
+        if expected_answer:
+            rec = KaldiRecognizer(self.model, self.sample_rate, answer_grammar(expected_answer))
+            rec.SetWords(True)  # Word confidences decide on the fallback
+            fallback = lambda: KaldiRecognizer(self.model, self.sample_rate)
+        else:
+            rec = KaldiRecognizer(self.model, self.sample_rate)
+        session = RecognitionSession(rec,
+                                     frame_bytes=frame_size * 2,
+                                     buffer_bytes=self.buffer_bytes,
+                                     emit=emit,
+                                     vad=VadGate(self.sample_rate) if self.vad else None,
+                                     partial_interval_ms=partial_interval_ms,
+                                     fallback=fallback)
+        self.pool.open(session)
+        return session
 
-    def open_stream(self):
-        if self.stream is None or not self.stream.is_active():
-            self.stream = self.audio.open(format=pyaudio.paInt16,
-                                        channels=1,
-                                        rate=self.sample_rate,
-                                        input=True,
-                                        frames_per_buffer=self.frame_size)
-            self.stream.start_stream()
-            logger.info('Audio stream opened.')
-
-    def close_stream(self):
-        if self.stream is not None:
-            self.stream.stop_stream()
-            self.stream.close()
-            self.stream = None
-            logger.info('Audio stream closed.')
-        self.audio.terminate()  
-        self.audio = pyaudio.PyAudio()  
-        logger.info('Audio stream closed and reset.')
-
-    async def recognize_stream(self, websocket):
+    async def recognize_stream(self, websocket, expected_answer=None):
+        """Recognizes the server's own microphone (one session at a time)."""
         self.stop()
-        self.open_stream()
-        rec = KaldiRecognizer(self.model, self.sample_rate)
-        rec.Reset() 
-        self.is_running = True
-        last_final_text = ""
-        last_partial_text = ""
+        results = asyncio.Queue()
+        session = self.open_session(results, expected_answer=expected_answer)
+        loop = asyncio.get_running_loop()
+
+        def write(data):
+            session.ring.write(data)
+            self.pool.wake(session)
+
+        def finish():
+            session.stopped.set()
+            self.pool.wake(session)
+
+        try:
+            # Attach first so a stop arriving while the device opens is not missed
+            self.microphone.attach(write, finish)
+            await loop.run_in_executor(None, self.start_microphone)
+            await self._send_results(websocket, results)
+        except Exception as e:
+            logger.error(f"Error during audio capture: {e}")
+            finish()
+            await websocket.send_json({"type": "error", "text": f"Ошибка распознавания: {str(e)}"})
+        finally:
+            self.microphone.detach(write)
+
+    async def recognize_client(self, websocket, profile=None, expected_answer=None):
+        """Recognizes 16 kHz mono PCM16 frames sent by the browser.
+
+        A {"action": "stop"} text message ends the utterance: the remaining
+        audio is decoded and the final result is sent before this returns.
+        """
+        results = asyncio.Queue()
+        session = self.open_session(results, profile, expected_answer)
+        sender = asyncio.create_task(self._send_results(websocket, results))
 
         try:
-            while self.is_running:
-                try:
-                    data = self.stream.read(self.frame_size, exception_on_overflow=False)
-                    if rec.AcceptWaveform(data):
-                        result = json.loads(rec.Result())
-                        if "text" in result and result["text"].strip():
-                            current_text = result["text"]
-                            if current_text != last_final_text:
-                                await websocket.send_json({
-                                    "type": "final",
-                                    "text": current_text
-                                })
-                                last_final_text = current_text
-                                last_partial_text = ""
-                    else:
-                        partial = json.loads(rec.PartialResult())
-                        if "partial" in partial and partial["partial"].strip():
-                            current_partial = partial["partial"]
-                            if (current_partial != last_partial_text and 
-                                current_partial != last_final_text):
-                                await websocket.send_json({
-                                    "type": "partial",
-                                    "text": current_partial
-                                })
-                                last_partial_text = current_partial
-                    
-                    # Give other tasks a chance to run
-                    await asyncio.sleep(0.01)
-                except Exception as e:
-                    logger.error(f"Error during recognition: {e}")
-                    await websocket.send_json({
-                        "type": "error",
-                        "text": f"Ошибка распознавания: {str(e)}"
-                    })
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
                     break
+                if message.get("bytes"):
+                    session.ring.write(message["bytes"])
+                    self.pool.wake(session)
+                elif message.get("text"):
+                    if json.loads(message["text"]).get("action") == "stop":
+                        break
         finally:
-            self.close_stream()
-            self.is_running = False
+            session.stopped.set()
+            self.pool.wake(session)
+            await sender
+
+    async def _send_results(self, websocket, results):
+        while True:
+            message = await results.get()
+            if message is None:
+                break
+            try:
+                await websocket.send_json(message)
+            except Exception as e:
+                logger.info(f"Recognition results dropped, websocket closed: {e}")
+                break
+
+    async def transcribe(self, path):
+        """Offline transcription of a WAV/FLAC file with the shared model,
+        on its own threads so live sessions keep their pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.batch_executor, transcribe_file, self.model, path)
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.microphone.close()
+        self.pool.shutdown()
+        self.batch_executor.shutdown(wait=False)
 
     def stop(self):
-        self.is_running = False
+        """Ends the server-microphone session, if any; the device stays open."""
+        self.microphone.detach()
 
 class TextToSpeechPlayer:
-    """ Text to speech class """
-    def __init__(self, model_path=r'lang_models/v3_1_ru.pt', sample_rate=48000):
-        self.model_path = Path(model_path)
-        if not self.model_path.exists():
-            raise FileNotFoundError(f"Model file not found: {model_path}")
-        
-        # Load model
-        self.device = torch.device('cpu')
-        torch.set_num_threads(4)
-        self.model = torch.package.PackageImporter(str(self.model_path)).load_pickle("tts_models", "model")
-        self.model.to(self.device)
+    """ Text to speech class
+
+    Plays speech on the server's speakers. Synthesis goes through the shared
+    SpeechSynthesizer, so the player holds no model of its own.
+    """
+    def __init__(self, synthesizer):
+        self.synthesizer = synthesizer
+        self.sample_rate = synthesizer.sample_rate
         
         # Queue for texts
         self.text_queue = queue.Queue()
-        self.sample_rate = sample_rate
         self.is_running = False
         
         # Start playback thread
@@ -133,9 +202,7 @@ class TextToSpeechPlayer:
                 if text is None:
                     break
                 # Generate audio
-                audio = self.model.apply_tts(text=text,
-                                          speaker='kseniya',
-                                          sample_rate=self.sample_rate)
+                audio = self.synthesizer.submit(text, "server").result()
                
                 # Play through speakers
                 sd.play(audio, self.sample_rate)
@@ -153,19 +220,104 @@ class TextToSpeechPlayer:
         self.text_queue.put(None)
         self.playing_thread.join()
 
+# Task prefixes shown before the translated exercise, by native language
+TRANSLATION_PROMPTS = {
+    "Russian": "переведи на английский следующую фразу: ",
+    "Ukrainian": "переклади англійською наступну фразу: ",
+    "French": "traduisez la phrase suivante en anglais: "
+}
+QUESTION_PROMPTS = {
+    "Russian": "дай свой ответ на следующий вопрос: ",
+    "Ukrainian": "дай свою відповідь на наступне запитання: ",
+    "French": "donnez votre réponse à la question suivante: "
+}
+NATIVE_LANGUAGES = tuple(TRANSLATION_PROMPTS)
+
+def exercise_source_text(text: str) -> str:
+    """The part of an entry that is sent for translation."""
+    return text.rstrip('?')
+
+def build_exercise_prompt(interaction_type: str, native_lang: str, translation: str) -> str:
+    if interaction_type == "translation":
+        return TRANSLATION_PROMPTS[native_lang] + translation
+    return QUESTION_PROMPTS[native_lang] + translation + "?"
+
+# Bump when the analysis prompts change, so cached analyses of the old prompts are not reused
+ANALYSIS_PROMPT_VERSION = 1
+
 # LLM model for translations and explanations
 class EnglishAssistant:
-    """ Class for assistant """
-    def __init__(self, model_path):
-        self.llm = Llama(
-            model_path=model_path,
-            n_ctx=16384,
-            n_gpu_layers=50
-        )
-        self.question = ""
-        
-    def process_request(self, text, native_lang, explanations):
+    """ Class for assistant, shared by all users.
 
+    The model comes from a ModelRegistry so one GGUF is loaded once per process;
+    per-user state (the current question) is passed in from a UserSession.
+    Extra `replica` assistants get their own context for concurrent decoding.
+    With `draft_model_path` set, a small model drafts `draft_tokens` tokens
+    ahead for speculative decoding. The model itself is any LlmBackend; pass a
+    `backend` factory (e.g. FakeBackend) when no registry is given.
+    """
+    def __init__(self, model_path, registry=None, n_ctx=16384, n_gpu_layers=50, replica=0,
+                 prefix_cache_mb=256, reply_tokens=512, draft_model_path=None, draft_tokens=4,
+                 backend=None, **llama_params):
+        self.model_path = model_path
+        self.registry = registry or ModelRegistry(backend=backend or Llama)
+        self.draft = None
+        self.draft_model_path = draft_model_path
+        if draft_model_path:
+            # Its own registry entry: one draft context per replica, counted in the budget
+            self.draft_params = {"n_ctx": n_ctx, "n_threads": llama_params.get("n_threads"),
+                                 "verbose": False, "replica": replica}
+            draft_llm = self.registry.acquire(draft_model_path,
+                                              kv_bytes_per_token=DRAFT_KV_BYTES_PER_TOKEN,
+                                              **self.draft_params)
+            self.draft = SmallModelDraft(draft_llm, num_pred_tokens=draft_tokens)
+            llama_params["draft_model"] = self.draft
+        self.llm_params = {"n_ctx": n_ctx, "n_gpu_layers": n_gpu_layers, "replica": replica, **llama_params}
+        try:
+            self.llm = self.registry.acquire(model_path, **self.llm_params)
+        except Exception:
+            if self.draft:
+                self.registry.release(draft_model_path, **self.draft_params)
+            raise
+        self.prefix_cache = PrefixStateCache(prefix_cache_mb)
+        self._prefix_key = None  # System prompt whose KV the context currently holds
+        self._grammars = {}  # Section tuple -> compiled LlamaGrammar
+        self.reply_tokens = reply_tokens  # Context kept free for the answer
+        if self.draft and self.draft.llm.n_vocab() != self.llm.n_vocab():
+            logger.warning(f"Draft model {draft_model_path} has a different vocabulary, "
+                           f"speculative decoding will rarely accept tokens")
+
+    def close(self):
+        self.registry.release(self.model_path, **self.llm_params)
+        if self.draft:
+            self.registry.release(self.draft_model_path, **self.draft_params)
+
+    def _tokenize(self, text):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=False)
+
+    def _fit_messages(self, messages, reply_tokens=None):
+        """Trims the oldest text so prompt and reply fit into n_ctx instead of overflowing.
+
+        History (messages between the system prompt and the latest one) is cut
+        first, then the start of the latest message; the system prompt is kept.
+        """
+        reply_tokens = max(self.reply_tokens, reply_tokens or 0)
+        limit = self.llm.n_ctx() - reply_tokens - 8 * len(messages)  # 8: chat markup per message
+        excess = sum(len(self._tokenize(m["content"])) for m in messages) - limit
+        if excess <= 0:
+            return messages
+        logger.warning(f"Prompt is {excess} tokens over the context window, truncating history")
+        messages = [dict(m) for m in messages]
+        for i in list(range(1, len(messages) - 1)) + [len(messages) - 1]:
+            if excess <= 0:
+                break
+            tokens = self._tokenize(messages[i]["content"])
+            cut = min(len(tokens), excess)
+            messages[i]["content"] = self.llm.detokenize(tokens[cut:]).decode("utf-8", errors="ignore")
+            excess -= cut
+        return messages
+        
+    def _system_prompt(self, native_lang, explanations):
         system_part=[
             f"You are an English learning assistant."
             f"The transcript is not perfect and may contain errors."
@@ -174,7 +326,6 @@ class EnglishAssistant:
             f"Give your explanations in the language: {native_lang}."
             f"The words may be consonant then recognition will not understand it. But this is not a mistake."
         ]
-        user_part= text
         # Add explanation requests
         if explanations:
             system_part.append("Also provide explanations for:")
@@ -184,42 +335,151 @@ class EnglishAssistant:
                 system_part.append("- Pronunciation tips (in IPA notation)")
             if "alternatives" in explanations:
                 system_part.append("- Alternative translation options or phrasings")
-        
+        return "\n".join(system_part)
+
+    def _analysis_messages(self, text, native_lang, explanations, question):
+        system_part = self._system_prompt(native_lang, explanations)
+        user_part= text
+        return [
+            {"role": "system", "content": system_part},
+            {"role": "assistant", "content": f"{question}"},
+            {"role": "user", "content": user_part},
+        ]
 
+    def _use_prefix(self, key):
+        """Restores the cached KV state for this system prompt, if we have one."""
+        if self._prefix_key == key:
+            return
+        state = self.prefix_cache.get(key)
+        if state is not None:
+            self.llm.load_state(state)
+        self._prefix_key = key
+
+    def _remember_prefix(self):
+        """Saves the context state after the first request with a new system prompt."""
+        if (self.prefix_cache.enabled and self._prefix_key is not None
+                and self._prefix_key not in self.prefix_cache):
+            self.prefix_cache.put(self._prefix_key, self.llm.save_state())
+
+    def process_request(self, text, native_lang, explanations, question="", should_stop=None):
+        messages = self._analysis_messages(text, native_lang, explanations, question)
+        self._use_prefix(messages[0]["content"])
         # Get response from LLM
-        response = self.llm.create_chat_completion(
-            messages=[
-                {"role": "system", "content": system_part},
-                {"role": "assistant", "content": f"{self.question}"},
-                {"role": "user", "content": user_part},
-            ]
+        response = self._chat(
+            messages=messages,
+            should_stop=should_stop
         )
+        self._remember_prefix()
         
         return response["choices"][0]["message"]["content"].strip()
+
+    def process_structured(self, text, native_lang, explanations, question="", should_stop=None):
+        """Analysis as a dict of sections, constrained by a JSON grammar.
+
+        Every section has its own token budget, so the worst-case length (and
+        latency) is bounded by the explanation set the user picked. The budgets
+        become character caps for the learner's language.
+        """
+        sections = analysis_sections(explanations)
+        key = (tuple(sections), chars_per_token(native_lang))
+        if key not in self._grammars:
+            self._grammars[key] = LlamaGrammar.from_string(sections_grammar(sections, native_lang),
+                                                           verbose=False)
+        messages = self._analysis_messages(text, native_lang, explanations, question)
+        messages[0]["content"] += (
+            "\nReply only with a JSON object with the fields: "
+            + ", ".join(sections)
+            + ". verdict says how correct the answer is; the other fields hold the requested explanations."
+        )
+        self._use_prefix(messages[0]["content"])
+        response = self._chat(
+            messages=messages,
+            should_stop=should_stop,
+            grammar=self._grammars[key],
+            max_tokens=sections_max_tokens(sections, native_lang)
+        )
+        self._remember_prefix()
+
+        content = response["choices"][0]["message"]["content"]
+        try:
+            parsed = json.loads(content)
+        except json.JSONDecodeError:
+            # Cancelled or cut short: keep the sections that were completed
+            parsed = salvage_sections(content)
+            logger.warning(f"Structured analysis incomplete, kept sections: {list(parsed)}")
+        return {name: str(parsed.get(name, "")).strip() for name in sections}
+
+    def stream_request(self, text, native_lang, explanations, question="", should_stop=None):
+        """Same as process_request, but yields the explanation token by token."""
+        messages = self._analysis_messages(text, native_lang, explanations, question)
+        self._use_prefix(messages[0]["content"])
+        chunks = self.llm.create_chat_completion(
+            messages=self._fit_messages(messages),
+            stream=True
+        )
+        for chunk in chunks:
+            if should_stop and should_stop():
+                break
+            token = chunk["choices"][0]["delta"].get("content")
+            if token:
+                yield token
+        self._remember_prefix()
     
-    def get_native_responce(self, text_to_translate, native_lang):
-        response = self.llm.create_chat_completion(
+    def get_native_responce(self, text_to_translate, native_lang, should_stop=None):
+        self._prefix_key = None
+        response = self._chat(
             messages=[
                 {"role": "system", "content": 
                  f"""just a translation without any additional explanatory phrases,
                     only exclusively translation to {native_lang}"""
                 },
                 {"role": "user", "content": f"{text_to_translate}"},
-            ]
+            ],
+            should_stop=should_stop
         )
-        self.llm.reset()
         return response
+
+    def _chat(self, messages, should_stop=None, **kwargs):
+        """Chat completion that can be aborted between tokens via should_stop()."""
+        messages = self._fit_messages(messages, kwargs.get("max_tokens"))
+        if should_stop is None:
+            return self.llm.create_chat_completion(messages=messages, **kwargs)
+
+        content = []
+        finish_reason = None
+        for chunk in self.llm.create_chat_completion(messages=messages, stream=True, **kwargs):
+            if should_stop():
+                finish_reason = "cancelled"
+                break
+            choice = chunk["choices"][0]
+            content.append(choice["delta"].get("content", ""))
+            finish_reason = choice.get("finish_reason") or finish_reason
+        return {
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(content)},
+                "finish_reason": finish_reason,
+            }]
+        }
+
 class DataManager:
-    def __init__(self, db_path: str = "data/data.db", data_folder: str = "data"):
+    """Exercise entries and their translations in SQLite.
+
+    The server opens it with `refresh=True`: the data files are re-imported
+    and every entry is marked unused. Offline tools pass `refresh=False` to
+    work on the live database without resetting the learners' progress.
+    """
+    def __init__(self, db_path: str = "data/data.db", data_folder: str = "data", refresh: bool = True):
         self.db_path = db_path
         self.data_folder = data_folder
         self.files = {"question": "question.txt", "translation": "translation.txt"}
         self._init_db()
-        self._update_db_from_files()
-        self._reset_used()
+        if refresh:
+            self._update_db_from_files()
+            self._reset_used()
         
     def _init_db(self) -> None:
-        """Creates a table if it does not exist."""
+        """Creates tables if they do not exist."""
         conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
         cur.execute("""
@@ -231,6 +491,14 @@ class DataManager:
                 used BOOLEAN DEFAULT 0
             )
         """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS translations (
+                entry_id INTEGER,
+                native_lang TEXT,
+                text TEXT,
+                PRIMARY KEY (entry_id, native_lang)
+            )
+        """)
         conn.commit()
         conn.close()
 
@@ -250,26 +518,37 @@ class DataManager:
                 self._load_file_into_db(path, entry_type)
     
     def _load_file_into_db(self, filepath: str, entry_type: str) -> None:
-        """Loads data from a file into a database."""
+        """Loads data from a file into a database.
+
+        Unchanged lines keep their ids, so precomputed translations stay valid.
+        """
         with open(filepath, encoding="utf-8") as f:
             lines = [line.strip() for line in f if line.strip()]
         
         conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
-        cur.execute("DELETE FROM entries WHERE type = ?", (entry_type,))
+        cur.execute("SELECT id, level, text FROM entries WHERE type = ? ORDER BY id", (entry_type,))
+        existing = {}
+        for entry_id, level, text in cur.fetchall():
+            existing.setdefault((level, text), []).append(entry_id)
         
         level = None
         for line in lines:
             if line.isdigit():
                 level = int(line)
+            elif existing.get((level, line)):
+                existing[(level, line)].pop(0)
             else:
                 cur.execute("INSERT INTO entries (type, level, text) VALUES (?, ?, ?)", (entry_type, level, line))
         
+        removed = [(entry_id,) for ids in existing.values() for entry_id in ids]
+        cur.executemany("DELETE FROM entries WHERE id = ?", removed)
+        cur.executemany("DELETE FROM translations WHERE entry_id = ?", removed)
         conn.commit()
         conn.close()
     
-    def get_next_entry(self, entry_type: str, level: int) -> Optional[str]:
-        """Gets the next unused question/sentence."""
+    def get_next(self, entry_type: str, level: int) -> Optional[Tuple[int, str]]:
+        """Gets the id and text of the next unused question/sentence."""
         conn = sqlite3.connect(self.db_path)
         cur = conn.cursor()
         cur.execute(
@@ -283,10 +562,74 @@ class DataManager:
             cur.execute("UPDATE entries SET used = 1 WHERE id = ?", (entry_id,))
             conn.commit()
             conn.close()
-            return text
+            return entry_id, text
         else:
             conn.close()
             return None  # Все использованы
+
+    def release_entry(self, entry_id: int) -> None:
+        """Returns an entry that was taken but never shown to the pool."""
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute("UPDATE entries SET used = 0 WHERE id = ?", (entry_id,))
+        conn.commit()
+        conn.close()
+
+    def get_next_entry(self, entry_type: str, level: int) -> Optional[str]:
+        """Gets the next unused question/sentence."""
+        entry = self.get_next(entry_type, level)
+        return entry[1] if entry else None
+
+    def get_translation(self, entry_id: int, native_lang: str) -> Optional[str]:
+        """Returns the precomputed translation of an entry, if there is one."""
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT text FROM translations WHERE entry_id = ? AND native_lang = ?",
+            (entry_id, native_lang),
+        )
+        row = cur.fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def save_translation(self, entry_id: int, native_lang: str, text: str) -> None:
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO translations (entry_id, native_lang, text) VALUES (?, ?, ?)",
+            (entry_id, native_lang, text),
+        )
+        conn.commit()
+        conn.close()
+
+    def get_untranslated(self, native_lang: str) -> List[Tuple[int, str]]:
+        """Entries that have no translation into native_lang yet."""
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT id, text FROM entries
+               WHERE id NOT IN (SELECT entry_id FROM translations WHERE native_lang = ?)
+               ORDER BY id""",
+            (native_lang,),
+        )
+        rows = cur.fetchall()
+        conn.close()
+        return rows
+
+    def get_translated(self, native_lang: str) -> List[Tuple[int, str, str]]:
+        """(entry id, entry type, translation) of every entry translated into native_lang."""
+        conn = sqlite3.connect(self.db_path)
+        cur = conn.cursor()
+        cur.execute(
+            """SELECT entries.id, entries.type, translations.text FROM entries
+               JOIN translations ON translations.entry_id = entries.id
+               WHERE translations.native_lang = ?
+               ORDER BY entries.id""",
+            (native_lang,),
+        )
+        rows = cur.fetchall()
+        conn.close()
+        return rows
         
 # Data Models
 class User(BaseModel):
@@ -310,6 +653,49 @@ def hash_password(password: str) -> str:
     hashed = bcrypt.hashpw(password.encode("utf-8"), salt)
     return hashed.decode("utf-8")
 
+# Per-user state that must not live on shared models
+class UserSession:
+    def __init__(self):
+        self.question = ""
+        self.expected_answer = ""  # English answer of a translation exercise, narrows speech recognition
+        # Next exercise generated in the background, valid for prefetch_key settings only
+        self.prefetch_key = None
+        self.prefetch_task = None
+        self._on_discard = None
+
+    def start_prefetch(self, key, coro, on_discard=None):
+        """Starts preparing the next exercise for the given settings."""
+        self.discard_prefetch()
+        self.prefetch_key = key
+        self.prefetch_task = asyncio.ensure_future(coro)
+        self._on_discard = on_discard
+
+    async def take_prefetch(self, key):
+        """Returns the prefetched exercise if it was made for these settings."""
+        task = self.prefetch_task
+        if task is None:
+            return None
+        if self.prefetch_key != key:
+            self.discard_prefetch()
+            return None
+        self.prefetch_task = None
+        try:
+            return await task
+        except Exception as e:
+            logger.warning(f"Prefetch failed: {e}")
+            return None
+
+    def discard_prefetch(self):
+        """Drops the prefetched exercise, e.g. after the settings changed."""
+        task, self.prefetch_task = self.prefetch_task, None
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None and task.result():
+            if self._on_discard:
+                self._on_discard(task.result())
+
 # Manage resources for each user
 class UserResources:
     def __init__(self):
@@ -318,17 +704,13 @@ class UserResources:
     def get_or_create_resources(self, user_id: str):
         if user_id not in self.resources:
             self.resources[user_id] = {
-                "tts_player": None,
                 "speech_recognizer": None,
-                "english_assistant": None,
+                "session": UserSession(),
             }
         return self.resources[user_id]
     
     def cleanup_resources(self, user_id: str):
         if user_id in self.resources:
-            resources = self.resources[user_id]
-            if resources["tts_player"]:
-                resources["tts_player"].stop()
             self.resources.pop(user_id)
 
 # Class for managing users
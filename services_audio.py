@@ -0,0 +1,516 @@
+import json
+import os
+import re
+import threading
+import time
+import wave
+from collections import deque
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pyaudio
+from vosk import KaldiRecognizer
+
+try:
+    import soundfile
+except ImportError:  # WAV still works through the standard library
+    soundfile = None
+
+from logger_config import logger
+
+
+class RecognitionProfile(NamedTuple):
+    frame_size: int  # Samples decoded per step
+    partial_interval_ms: int  # Minimum gap between partial results, 0 = every frame
+
+
+RECOGNITION_PROFILES = {
+    "default": RecognitionProfile(frame_size=4000, partial_interval_ms=0),  # 250 ms frames
+    "low_latency": RecognitionProfile(frame_size=1600, partial_interval_ms=200),  # 100 ms frames
+}
+
+
+class AudioRingBuffer:
+    """Single-producer/single-consumer ring buffer for raw PCM bytes.
+
+    The writer only advances `written` and the reader only advances `read_pos`,
+    so audio is handed between the capture and recognition threads without a
+    lock. A reader that falls more than `capacity` bytes behind skips the
+    oldest audio instead of blocking the writer.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.written = 0
+        self.read_pos = 0
+        self._data_ready = threading.Event()  # Only wakes the reader up
+
+    def write(self, data):
+        size = len(data)
+        if size > self.capacity:
+            data = data[-self.capacity:]
+            self.written += size - self.capacity
+            size = self.capacity
+        start = self.written % self.capacity
+        first = min(size, self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:size - first] = data[first:]
+        self.written += size
+        self._data_ready.set()
+
+    def available(self):
+        return self.written - self.read_pos
+
+    def read(self, size, timeout=None):
+        """Returns exactly `size` bytes, or None if they did not arrive in time."""
+        while self.available() < size:
+            self._data_ready.clear()
+            if self.available() >= size:
+                break
+            if not self._data_ready.wait(timeout):
+                return None
+        if self.available() > self.capacity:
+            self.read_pos = self.written - self.capacity  # Overrun: drop the oldest audio
+        start = self.read_pos % self.capacity
+        first = min(size, self.capacity - start)
+        data = bytes(self.buffer[start:start + first]) + bytes(self.buffer[:size - first])
+        self.read_pos += size
+        return data
+
+
+class VadGate:
+    """Energy/zero-crossing voice activity gate in front of KaldiRecognizer.
+
+    Each frame is split into short windows. A window is speech when its RMS is
+    well above the adaptive noise floor and its zero-crossing rate is below
+    that of broadband hiss. Silent frames are not decoded but kept as pre-roll,
+    so the first syllable is not clipped when speech starts. After
+    `end_silence_ms` of silence following speech the utterance is reported as
+    ended, so the final result can be produced right away.
+    """
+    def __init__(self, sample_rate=16000, window_ms=25, pre_roll_ms=300, end_silence_ms=700,
+                 energy_ratio=3.0, min_rms=300.0, max_zcr=0.35):
+        self.sample_rate = sample_rate
+        self.window = sample_rate * window_ms // 1000
+        self.pre_roll_bytes = sample_rate * 2 * pre_roll_ms // 1000
+        self.end_silence_ms = end_silence_ms
+        self.energy_ratio = energy_ratio
+        self.min_rms = min_rms
+        self.max_zcr = max_zcr
+        self.noise_floor = min_rms / energy_ratio
+        self.pre_roll = deque()
+        self.pre_roll_size = 0
+        self.in_speech = False
+        self.silence_ms = 0
+        self.voiced_bytes = 0
+        self.silent_bytes = 0
+
+    def _speech_windows(self, data):
+        samples = np.frombuffer(data, dtype=np.int16)
+        count = len(samples) // self.window
+        if count == 0:
+            return np.zeros(0, dtype=bool)
+        windows = samples[:count * self.window].reshape(count, self.window).astype(np.float32)
+        rms = np.sqrt(np.mean(windows ** 2, axis=1))
+        signs = np.signbit(windows)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+        loud = rms > max(self.min_rms, self.noise_floor * self.energy_ratio)
+        speech = loud & (zcr < self.max_zcr)
+        # Learn the floor from quiet windows between utterances only: loud sibilants
+        # fail just the zero-crossing test and would otherwise raise it mid-sentence
+        if not self.in_speech and not loud.all():
+            self.noise_floor = 0.9 * self.noise_floor + 0.1 * float(rms[~loud].mean())
+        return speech
+
+    def process(self, data):
+        """Returns (audio to decode, whether the utterance has just ended)."""
+        speech = self._speech_windows(data)
+        window_ms = 1000 * self.window / self.sample_rate
+        if speech.any():
+            trailing = len(speech) - 1 - int(np.flatnonzero(speech)[-1])
+            self.silence_ms = trailing * window_ms
+            if not self.in_speech:
+                self.in_speech = True
+                data = b"".join(self.pre_roll) + data
+                self.pre_roll.clear()
+                self.pre_roll_size = 0
+            self.voiced_bytes += len(data)
+            return data, False
+        if self.in_speech:
+            # Keep decoding the pause after speech; Kaldi needs it to close the last word
+            self.silence_ms += len(speech) * window_ms
+            self.voiced_bytes += len(data)
+            if self.silence_ms >= self.end_silence_ms:
+                self.in_speech = False
+                self.silence_ms = 0
+                return data, True
+            return data, False
+        self.silent_bytes += len(data)
+        self.pre_roll.append(data)
+        self.pre_roll_size += len(data)
+        while self.pre_roll_size - len(self.pre_roll[0]) >= self.pre_roll_bytes:
+            self.pre_roll_size -= len(self.pre_roll.popleft())
+        return b"", False
+
+
+class MicrophoneCapture:
+    """The server's microphone, opened once and read continuously.
+
+    A background thread keeps the last `pre_roll_ms` of audio. Attaching a
+    session first hands it that pre-roll and then every new frame, so the
+    start of a session pays no device start-up cost and keeps the syllable
+    spoken just before the click. PyAudio is only terminated by close().
+    """
+    def __init__(self, sample_rate=16000, frame_size=1600, pre_roll_ms=500):
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        frames = max(1, sample_rate * pre_roll_ms // 1000 // frame_size)
+        self.pre_roll = deque(maxlen=frames)
+        self.audio = None
+        self.stream = None
+        self.running = False
+        self._thread = None
+        self._lock = threading.Lock()  # Orders pre-roll hand-over against new frames
+        self._sink = None  # (write, stop) of the attached session
+
+    def start(self):
+        if self.running:
+            return
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16,
+                                      channels=1,
+                                      rate=self.sample_rate,
+                                      input=True,
+                                      frames_per_buffer=self.frame_size)
+        self.stream.start_stream()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True, name="microphone")
+        self._thread.start()
+        logger.info('Audio stream opened.')
+
+    @property
+    def attached(self):
+        return self._sink is not None
+
+    def attach(self, write, stop):
+        """Feeds the pre-roll and then live frames to `write`; `stop` is called
+        when the session is detached or the device fails."""
+        self.detach()
+        with self._lock:
+            for data in self.pre_roll:
+                write(data)
+            self._sink = (write, stop)
+
+    def detach(self, write=None):
+        """Detaches the session; with `write`, only if it is still that session."""
+        with self._lock:
+            sink = self._sink
+            if sink is None or (write is not None and sink[0] is not write):
+                return
+            self._sink = None
+        sink[1]()
+
+    def _run(self):
+        try:
+            while self.running:
+                data = self.stream.read(self.frame_size, exception_on_overflow=False)
+                with self._lock:
+                    self.pre_roll.append(data)
+                    if self._sink:
+                        self._sink[0](data)
+        except Exception as e:
+            logger.error(f"Error during audio capture: {e}")
+            self.running = False
+            self.detach()
+
+    def close(self):
+        self.detach()
+        self.running = False
+        if self._thread:
+            self._thread.join()
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.audio is not None:
+            self.audio.terminate()
+            self.audio = None
+        logger.info('Audio stream closed.')
+
+
+def answer_grammar(expected):
+    """Vosk grammar for an expected answer: the whole phrase, each of its words
+    and [unk], so near-misses still decode within the small search space."""
+    words = re.findall(r"[a-z']+", expected.lower())
+    return json.dumps([" ".join(words)] + sorted(set(words)) + ["[unk]"])
+
+
+class RecognitionBusy(Exception):
+    """Raised when every recognition session slot is taken."""
+
+
+class RecognitionSession:
+    """One websocket's recognition state.
+
+    The KaldiRecognizer is created per session over the shared, read-only Vosk
+    Model. Audio arrives through `ring`; results go out through `emit`, which
+    receives None once the session has finished. With a VadGate, silent
+    frames are skipped and the utterance is finalized as soon as the learner
+    stops speaking.
+
+    Partial results are polled at most every `partial_interval_ms` and sent as
+    deltas: {"type": "partial", "keep": n, "text": s} means "keep the first n
+    characters of the previous partial and append s".
+
+    When `rec` is constrained by an answer grammar, `fallback` creates an
+    open-vocabulary recognizer: a final result with [unk] or a word below
+    `min_confidence` is re-decoded from the buffered utterance audio with it.
+    """
+    def __init__(self, rec, frame_bytes, buffer_bytes, emit, vad=None, partial_interval_ms=0,
+                 fallback=None, min_confidence=0.6, max_utterance_bytes=30 * 16000 * 2):
+        self.rec = rec
+        self.vad = vad
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.utterance = bytearray()  # Audio of the current utterance, kept for the fallback
+        self.max_utterance_bytes = max_utterance_bytes
+        self.fallbacks = 0
+        self.frame_bytes = frame_bytes
+        self.partial_interval = partial_interval_ms / 1000
+        self.next_partial_at = 0.0
+        self.ring = AudioRingBuffer(buffer_bytes)
+        self.emit = emit
+        self.stopped = threading.Event()  # No more audio will arrive
+        self.queued = False  # Guarded by the pool's lock
+        self.active = False
+        self.last_final_text = ""
+        self.last_partial_text = ""
+
+    def has_work(self):
+        return self.ring.available() >= self.frame_bytes or self.stopped.is_set()
+
+    def step(self):
+        """Decodes one frame; returns True once the session has finished."""
+        try:
+            if self.ring.available() >= self.frame_bytes:
+                data = self.ring.read(self.frame_bytes, timeout=0)
+                ended = False
+                if self.vad:
+                    data, ended = self.vad.process(data)
+                if data:
+                    self._accept(data)
+                if ended:
+                    self._end_utterance()
+                return False
+            if not self.stopped.is_set():
+                return False
+            self._finish()
+        except Exception as e:
+            logger.error(f"Error during recognition: {e}")
+            self.emit({"type": "error", "text": f"Ошибка распознавания: {str(e)}"})
+        self.emit(None)
+        return True
+
+    def _accept(self, data):
+        if self.fallback:
+            self.utterance += data
+            if len(self.utterance) > self.max_utterance_bytes:
+                del self.utterance[:len(self.utterance) - self.max_utterance_bytes]
+        if self.rec.AcceptWaveform(data):
+            self._final(self.rec.Result())
+        else:
+            now = time.monotonic()
+            if now < self.next_partial_at:
+                return
+            self.next_partial_at = now + self.partial_interval
+            partial = json.loads(self.rec.PartialResult())
+            if "partial" in partial and partial["partial"].strip():
+                current_partial = partial["partial"]
+                if (current_partial != self.last_partial_text and 
+                    current_partial != self.last_final_text):
+                    keep = len(os.path.commonprefix([self.last_partial_text, current_partial]))
+                    self.emit({"type": "partial", "keep": keep, "text": current_partial[keep:]})
+                    self.last_partial_text = current_partial
+
+    def _end_utterance(self):
+        self._final(self.rec.FinalResult())
+
+    def _final(self, raw_result):
+        result = self._verified(json.loads(raw_result))
+        self.utterance.clear()
+        if result.get("text", "").strip() and result["text"] != self.last_final_text:
+            self.emit({"type": "final", "text": result["text"]})
+            self.last_final_text = result["text"]
+        self.last_partial_text = ""
+
+    def _verified(self, result):
+        """Re-decodes a doubtful constrained result with the open vocabulary."""
+        if self.fallback is None or not result.get("text", "").strip() or not self.utterance:
+            return result
+        words = result.get("result", [])
+        confidence = min((word["conf"] for word in words), default=0.0)
+        if "[unk]" not in result["text"] and confidence >= self.min_confidence:
+            return result
+        self.fallbacks += 1
+        rec = self.fallback()
+        rec.AcceptWaveform(bytes(self.utterance))
+        return json.loads(rec.FinalResult())
+
+    def _finish(self):
+        # Decode whatever is left so the last words are not lost
+        tail = self.ring.available()
+        if tail:
+            data = self.ring.read(min(tail, self.ring.capacity), timeout=0)
+            if self.vad:
+                data, _ = self.vad.process(data)
+            if data:
+                self._accept(data)
+        self._end_utterance()
+
+
+class RecognitionPool:
+    """Fixed set of threads decoding frames for all open sessions.
+
+    Sessions with buffered audio wait in a round-robin queue and a worker
+    decodes one frame per turn, so a long utterance cannot starve the others.
+    A session is never decoded by two workers at once.
+    """
+    def __init__(self, workers=2, max_sessions=16):
+        self.max_sessions = max_sessions
+        self._sessions = set()
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.frames = 0
+        self.voiced_seconds = 0.0
+        self.skipped_seconds = 0.0
+        self.fallbacks = 0
+        self._threads = [threading.Thread(target=self._run, daemon=True, name=f"recognition-{i}")
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def open(self, session):
+        with self._cond:
+            if len(self._sessions) >= self.max_sessions:
+                raise RecognitionBusy(f"{self.max_sessions} recognition sessions already running")
+            self._sessions.add(session)
+
+    def wake(self, session):
+        """Called after new audio was written or the session was stopped."""
+        with self._cond:
+            if session in self._sessions and not session.queued and not session.active:
+                session.queued = True
+                self._ready.append(session)
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                session = self._ready.popleft()
+                session.queued = False
+                session.active = True
+            finished = session.step()
+            with self._cond:
+                session.active = False
+                self.frames += 1
+                if finished:
+                    self._sessions.discard(session)
+                    self.fallbacks += session.fallbacks
+                    if session.vad:
+                        bytes_per_second = session.vad.sample_rate * 2
+                        self.voiced_seconds += session.vad.voiced_bytes / bytes_per_second
+                        self.skipped_seconds += session.vad.silent_bytes / bytes_per_second
+                elif session.has_work():
+                    session.queued = True
+                    self._ready.append(session)
+                    self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "workers": len(self._threads),
+                "ready": len(self._ready),
+                "frames": self.frames,
+                "voiced_seconds": round(self.voiced_seconds, 1),
+                "skipped_seconds": round(self.skipped_seconds, 1),
+                "fallbacks": self.fallbacks,
+            }
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+
+def read_pcm16_chunks(path, chunk_frames=8000):
+    """Returns (sample_rate, iterator of mono PCM16 byte chunks) for a WAV or FLAC file.
+
+    The file is read `chunk_frames` at a time, so long recordings are never
+    loaded into memory whole. FLAC (and non-16-bit WAV) need the soundfile
+    package.
+    """
+    path = Path(path)
+    if soundfile is not None:
+        info = soundfile.info(str(path))
+
+        def chunks():
+            for block in soundfile.blocks(str(path), blocksize=chunk_frames, dtype="int16", always_2d=True):
+                yield _to_mono(block)
+        return info.samplerate, chunks()
+
+    if path.suffix.lower() != ".wav":
+        raise ValueError(f"Install soundfile to read {path.suffix} files: {path.name}")
+    reader = wave.open(str(path), "rb")
+    if reader.getsampwidth() != 2:
+        reader.close()
+        raise ValueError(f"Only 16-bit WAV is supported without soundfile: {path.name}")
+    channels = reader.getnchannels()
+
+    def chunks():
+        with reader:
+            while True:
+                data = reader.readframes(chunk_frames)
+                if not data:
+                    break
+                yield _to_mono(np.frombuffer(data, dtype=np.int16).reshape(-1, channels))
+    return reader.getframerate(), chunks()
+
+
+def _to_mono(block):
+    if block.shape[1] == 1:
+        return block.tobytes()
+    return block.mean(axis=1).astype(np.int16).tobytes()
+
+
+def transcribe_file(model, path, chunk_frames=8000):
+    """Decodes a recording with word-level timings.
+
+    Returns {"file", "text", "duration", "words": [{"word", "start", "end", "conf"}]},
+    times in seconds.
+    """
+    sample_rate, chunks = read_pcm16_chunks(path, chunk_frames)
+    rec = KaldiRecognizer(model, sample_rate)
+    rec.SetWords(True)
+    words = []
+    total_bytes = 0
+    for data in chunks:
+        total_bytes += len(data)
+        if rec.AcceptWaveform(data):
+            words.extend(json.loads(rec.Result()).get("result", []))
+    words.extend(json.loads(rec.FinalResult()).get("result", []))
+    return {
+        "file": Path(path).name,
+        "text": " ".join(word["word"] for word in words),
+        "duration": round(total_bytes / 2 / sample_rate, 2),
+        "words": words,
+    }
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+
+from logger_config import logger
+
+_resource = None
+_work = None
+
+
+def default_workers(threads_per_worker=1):
+    return max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+
+def _init_process(load, load_args, work):
+    global _resource, _work
+    _resource = load(*load_args)
+    _work = work
+
+
+def _run(job):
+    return _work(_resource, job)
+
+
+def process_map(work, jobs, load, load_args=(), workers=1, progress="jobs done", log_every=10):
+    """Yields work(resource, job) for every job, in completion order.
+
+    Jobs run in a pool of spawned processes; each one calls load(*load_args)
+    once, e.g. to load a model, and passes the result to every job it runs.
+    `work` and `load` must be module-level functions so they can be pickled.
+    Progress is logged every `log_every` results.
+    """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=_init_process, initargs=(load, load_args, work)) as pool:
+        for done, result in enumerate(pool.imap_unordered(_run, jobs), 1):
+            yield result
+            if done % log_every == 0 or done == len(jobs):
+                logger.info(f"{done}/{len(jobs)} {progress}")
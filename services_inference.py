@@ -0,0 +1,985 @@
+import asyncio
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple, Protocol
+
+import llama_cpp
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel
+
+from logger_config import logger
+
+MB = 1024 * 1024
+# fp16 K and V for Llama 3.1 8B: 32 layers * 8 kv heads * 128 dims * 2 * 2 bytes
+DEFAULT_KV_BYTES_PER_TOKEN = 128 * 1024
+# Same for a Llama 3.2 1B draft model: 16 layers * 8 kv heads * 64 dims * 2 * 2 bytes
+DRAFT_KV_BYTES_PER_TOKEN = 32 * 1024
+
+
+class LlmBackend(Protocol):
+    """What EnglishAssistant needs from a model; llama_cpp.Llama implements it."""
+    def create_chat_completion(self, messages, stream=False, **kwargs): ...
+    def tokenize(self, text: bytes, add_bos: bool = True) -> list: ...
+    def detokenize(self, tokens) -> bytes: ...
+    def n_ctx(self) -> int: ...
+    def n_vocab(self) -> int: ...
+    def save_state(self): ...
+    def load_state(self, state) -> None: ...
+
+
+class FakeState:
+    llama_state_size = 0
+
+
+class FakeBackend:
+    """Deterministic stand-in for llama.cpp, for load tests and profiling.
+
+    Replies are canned and derived from the last user message. `latency_ms`
+    simulates prompt processing before the first token and `tokens_per_second`
+    the decode rate, so web-layer costs can be measured without a GGUF on disk.
+    """
+    needs_model_file = False
+
+    def __init__(self, model_path=None, n_ctx=4096, latency_ms=200, tokens_per_second=20, **ignored):
+        self.model_path = model_path
+        self._n_ctx = n_ctx
+        self.latency = latency_ms / 1000
+        self.token_interval = 1 / tokens_per_second if tokens_per_second else 0
+
+    def _reply(self, messages, grammar):
+        answer = messages[-1]["content"] if messages else ""
+        if grammar is None:
+            return f"Fake reply to: {answer}"
+        # Structured mode: fill the fields the system prompt asks for
+        fields = re.search(r"fields: ([\w, ]+)\.", messages[0]["content"])
+        names = [name.strip() for name in fields.group(1).split(",")] if fields else ["verdict"]
+        return json.dumps({name: f"Fake {name} for: {answer}" for name in names}, ensure_ascii=False)
+
+    def create_chat_completion(self, messages, stream=False, grammar=None, max_tokens=None, **kwargs):
+        words = self._reply(messages, grammar).split(" ")
+        if max_tokens:
+            words = words[:max_tokens]
+        tokens = [word + " " for word in words[:-1]] + words[-1:]
+        if stream:
+            return self._stream(tokens)
+        time.sleep(self.latency + self.token_interval * len(tokens))
+        return {"choices": [{"index": 0,
+                             "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}]}
+
+    def _stream(self, tokens):
+        time.sleep(self.latency)
+        for token in tokens:
+            time.sleep(self.token_interval)
+            yield {"choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+        yield {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+
+    def tokenize(self, text, add_bos=True):
+        return list(text)  # One token per byte
+
+    def detokenize(self, tokens):
+        return bytes(tokens)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return 256
+
+    def save_state(self):
+        return FakeState()
+
+    def load_state(self, state):
+        pass
+
+
+BACKENDS = {"llama_cpp": Llama, "fake": FakeBackend}
+
+
+def model_file_size(model_path):
+    path = Path(model_path)
+    return path.stat().st_size if path.exists() else 0
+
+
+class LlamaPlan(NamedTuple):
+    n_ctx: int
+    n_threads: int
+    n_batch: int
+    n_gpu_layers: int
+    n_instances: int
+
+    def llama_params(self):
+        return {"n_ctx": self.n_ctx, "n_threads": self.n_threads,
+                "n_batch": self.n_batch, "n_gpu_layers": self.n_gpu_layers}
+
+
+def available_memory_bytes():
+    """MemAvailable from /proc/meminfo, falling back to free physical pages."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def plan_llama_resources(model_path, memory_budget_mb=None, max_instances=4, n_ctx=4096,
+                         min_ctx=1024, n_gpu_layers=50, min_threads=2,
+                         kv_bytes_per_token=DEFAULT_KV_BYTES_PER_TOKEN, prefix_cache_mb=0,
+                         draft_model_path=None, draft_kv_bytes_per_token=DRAFT_KV_BYTES_PER_TOKEN):
+    """Chooses llama.cpp sizing from measured RAM and cores.
+
+    The budget is the configured one capped at 80% of available memory. The
+    weights (and those of the draft model) are mmap'd once; every instance
+    adds a KV cache of n_ctx tokens, one for its draft context and its own
+    PrefixStateCache of `prefix_cache_mb`. n_ctx is halved (down to min_ctx)
+    until one instance fits, then as many instances as fit the rest of the
+    budget and the cores are planned.
+    """
+    available = available_memory_bytes()
+    budget = int(available * 0.8)
+    if memory_budget_mb:
+        budget = min(budget, memory_budget_mb * MB)
+    weights = model_file_size(model_path)
+    if draft_model_path:
+        weights += model_file_size(draft_model_path)
+        kv_bytes_per_token += draft_kv_bytes_per_token
+    cores = available_cores()
+
+    prefix_cache = prefix_cache_mb * MB
+    while n_ctx > min_ctx and weights + n_ctx * kv_bytes_per_token + prefix_cache > budget:
+        n_ctx //= 2
+    kv_cache = n_ctx * kv_bytes_per_token
+    by_memory = max(1, (budget - weights) // (kv_cache + prefix_cache))
+    n_instances = int(max(1, min(max_instances, by_memory, cores // min_threads)))
+
+    supports_gpu = getattr(llama_cpp, "llama_supports_gpu_offload", lambda: True)()
+    plan = LlamaPlan(
+        n_ctx=n_ctx,
+        n_threads=max(1, cores // n_instances),
+        n_batch=min(512, n_ctx),
+        n_gpu_layers=n_gpu_layers if supports_gpu else 0,
+        n_instances=n_instances,
+    )
+    logger.info(f"Llama plan: {plan._asdict()} (available ~{available // MB} MiB, "
+                f"budget ~{budget // MB} MiB, weights ~{weights // MB} MiB, "
+                f"prefix cache {prefix_cache_mb} MiB per instance, {cores} cores)")
+    if weights + kv_cache + prefix_cache > budget:
+        logger.warning("Llama plan: the model does not fit the memory budget even at the minimal context")
+    return plan
+
+
+class ModelRegistry:
+    """Process-wide registry of loaded GGUF models.
+
+    Every model file is loaded once and shared by all users. The number of
+    resident models is capped by an approximate memory budget: weights are
+    taken from the file size and the KV cache from n_ctx. Models nobody holds
+    are unloaded in least-recently-used order when a new one does not fit.
+    `backend` builds the model (llama_cpp.Llama by default, see BACKENDS).
+    """
+    def __init__(self, memory_budget_mb=None, kv_bytes_per_token=DEFAULT_KV_BYTES_PER_TOKEN,
+                 backend=Llama):
+        self.backend = backend
+        self.memory_budget = memory_budget_mb * MB if memory_budget_mb else None
+        self.kv_bytes_per_token = kv_bytes_per_token
+        self.models = OrderedDict()  # key -> {"llm", "refs", "bytes"}
+        self.loads = 0
+        self.unloads = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_path, params):
+        return (str(Path(model_path).resolve()), tuple(sorted(params.items())))
+
+    def estimate_bytes(self, model_path, params, kv_bytes_per_token=None):
+        path = str(Path(model_path).resolve())
+        # Replicas of one file mmap the same weights, only their KV caches add up
+        shared = params.get("use_mmap", True) and any(key[0] == path for key in self.models)
+        weights = 0 if shared else model_file_size(model_path)
+        kv_cache = params.get("n_ctx", 512) * (kv_bytes_per_token or self.kv_bytes_per_token)
+        return weights + kv_cache
+
+    def resident_bytes(self):
+        return sum(entry["bytes"] for entry in self.models.values())
+
+    def acquire(self, model_path, replica=0, kv_bytes_per_token=None, **params):
+        """Returns a shared Llama for the file/parameter pair, loading it if needed.
+
+        Distinct `replica` numbers give separate contexts over the same weights,
+        so several sequences can decode at once. `kv_bytes_per_token` overrides
+        the registry's estimate for models of another size (e.g. a draft).
+        """
+        needs_file = getattr(getattr(self.backend, "func", self.backend), "needs_model_file", True)
+        if needs_file and not Path(model_path).exists():
+            raise FileNotFoundError(f"Model file not found: {model_path}")
+        key = self._key(model_path, dict(params, replica=replica))
+        with self._lock:
+            entry = self.models.get(key)
+            if entry is None:
+                size = self.estimate_bytes(model_path, params, kv_bytes_per_token)
+                self._make_room(size)
+                llm = self.backend(model_path=str(model_path), **params)
+                entry = {"llm": llm, "refs": 0, "bytes": size}
+                self.models[key] = entry
+                self.loads += 1
+                logger.info(f"Model loaded: {model_path} {params} replica={replica} "
+                            f"(~{size // MB} MiB, resident ~{self.resident_bytes() // MB} MiB)")
+            entry["refs"] += 1
+            self.models.move_to_end(key)
+            return entry["llm"]
+
+    def release(self, model_path, replica=0, **params):
+        """Drops one reference; the model stays resident until room is needed."""
+        key = self._key(model_path, dict(params, replica=replica))
+        with self._lock:
+            entry = self.models.get(key)
+            if entry and entry["refs"] > 0:
+                entry["refs"] -= 1
+
+    def _make_room(self, size):
+        if self.memory_budget is None:
+            return
+        for key in list(self.models):
+            if self.resident_bytes() + size <= self.memory_budget:
+                return
+            if self.models[key]["refs"] == 0:
+                self._unload(key)
+        if self.resident_bytes() + size > self.memory_budget:
+            raise MemoryError(f"Model needs ~{size // MB} MiB, which does not fit "
+                              f"the {self.memory_budget // MB} MiB budget")
+
+    def _unload(self, key):
+        entry = self.models.pop(key)
+        close = getattr(entry["llm"], "close", None)
+        if close:
+            close()
+        self.unloads += 1
+        logger.info(f"Model unloaded: {key[0]} (freed ~{entry['bytes'] // MB} MiB)")
+
+    def unload_all(self):
+        with self._lock:
+            for key in list(self.models):
+                self._unload(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "models": [{"path": key[0], "refs": entry["refs"], "mb": entry["bytes"] // MB}
+                           for key, entry in self.models.items()],
+                "resident_mb": self.resident_bytes() // MB,
+                "budget_mb": self.memory_budget // MB if self.memory_budget else None,
+                "loads": self.loads,
+                "unloads": self.unloads,
+            }
+
+
+# Structured analysis: section -> token budget. "verdict" is always present,
+# the others follow the explanation set picked in the settings.
+SECTION_TOKEN_BUDGETS = {
+    "verdict": 60,
+    "grammar": 120,
+    "pronunciation": 80,
+    "alternatives": 100,
+}
+# Rough characters per token of explanation text, used to turn token budgets
+# into grammar lengths. Cyrillic takes about twice as many tokens as Latin text.
+CHARS_PER_TOKEN = {"Russian": 2, "Ukrainian": 2}
+DEFAULT_CHARS_PER_TOKEN = 4
+
+
+def chars_per_token(native_lang):
+    return CHARS_PER_TOKEN.get(native_lang, DEFAULT_CHARS_PER_TOKEN)
+
+
+def analysis_sections(explanations):
+    return ["verdict"] + [name for name in SECTION_TOKEN_BUDGETS
+                          if name != "verdict" and name in (explanations or [])]
+
+
+def section_max_chars(name, native_lang):
+    return SECTION_TOKEN_BUDGETS[name] * chars_per_token(native_lang)
+
+
+def sections_grammar(sections, native_lang=None):
+    """GBNF for a flat JSON object with the given string fields, each length-capped."""
+    members = ' "," ws '.join(f'"\\"{name}\\":" ws {name}' for name in sections)
+    rules = [f'root ::= "{{" ws {members} ws "}}"']
+    for name in sections:
+        rules.append(f'{name} ::= "\\"" char{{0,{section_max_chars(name, native_lang)}}} "\\""')
+    rules.append(r'char ::= [^"\\\x00-\x1f] | "\\" ["\\/bfnrt]')
+    rules.append('ws ::= [ \\t\\n]{0,2}')
+    return "\n".join(rules)
+
+
+def sections_max_tokens(sections, native_lang=None):
+    """Covers the grammar's worst case, so max_tokens does not cut a reply mid-JSON.
+
+    Every character the grammar allows is counted as a token, plus keys and
+    JSON punctuation. The character caps, not this limit, bound the usual
+    reply length.
+    """
+    return sum(section_max_chars(name, native_lang) + 8 for name in sections) + 8
+
+
+def salvage_sections(content):
+    """String fields that were completed in a truncated or malformed JSON reply."""
+    fields = {}
+    for match in re.finditer(r'"(\w+)"\s*:\s*("(?:[^"\\]|\\.)*")', content):
+        try:
+            fields[match.group(1)] = json.loads(match.group(2))
+        except json.JSONDecodeError:
+            continue
+    return fields
+
+
+class SmallModelDraft(LlamaDraftModel):
+    """Draft model for llama.cpp speculative decoding backed by a small GGUF.
+
+    The small model `llm` (acquired from the ModelRegistry by its owner)
+    greedily proposes `num_pred_tokens` tokens and the main model verifies
+    them in one batch, keeping only what it would have produced itself. The
+    draft must share the main model's tokenizer (e.g. Llama 3.2 1B for
+    Llama 3.1 8B). Acceptance is measured from how many proposed tokens show
+    up in the next call's input and logged every `log_every` proposals.
+    """
+    def __init__(self, llm, num_pred_tokens=4, log_every=200):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+        self.log_every = log_every
+        self.proposed = 0
+        self.accepted = 0
+        self._last_input = []
+        self._last_draft = []
+        self._logged_at = 0
+
+    def _account(self, tokens):
+        previous = len(self._last_input)
+        if not self._last_draft or tokens[:previous] != self._last_input:
+            return  # New prompt, the previous draft was never verified
+        new_tokens = tokens[previous:]
+        accepted = 0
+        for proposed, actual in zip(self._last_draft, new_tokens):
+            if proposed != actual:
+                break
+            accepted += 1
+        self.proposed += len(self._last_draft)
+        self.accepted += accepted
+        if self.proposed - self._logged_at >= self.log_every:
+            self._logged_at = self.proposed
+            logger.info(f"Draft acceptance {self.acceptance_rate():.0%} "
+                        f"({self.accepted}/{self.proposed} tokens, lookahead {self.num_pred_tokens})")
+
+    def __call__(self, input_ids, **kwargs):
+        tokens = input_ids.tolist()
+        self._account(tokens)
+        draft = []
+        # generate() reuses the KV cache of the longest common prefix
+        for token in self.llm.generate(tokens, temp=0.0, top_k=1, reset=True):
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        self._last_input = tokens
+        self._last_draft = draft
+        return np.array(draft, dtype=np.intc)
+
+    def acceptance_rate(self):
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def stats(self):
+        return {"proposed": self.proposed, "accepted": self.accepted,
+                "acceptance_rate": round(self.acceptance_rate(), 3),
+                "lookahead": self.num_pred_tokens}
+
+
+class PrefixStateCache:
+    """LRU of llama states keyed by a rendered system prompt.
+
+    A state restored before a request lets llama.cpp keep the KV cache of the
+    longest common token prefix, so only the question and answer are
+    prefilled. Capacity is in bytes of saved state, which besides the KV data
+    includes llama-cpp-python's copy of the logits (n_batch x n_vocab
+    float32, ~250 MiB for a Llama 3 vocabulary at n_batch=512).
+    """
+    def __init__(self, capacity_mb=256):
+        self.capacity = capacity_mb * MB
+        self.states = OrderedDict()  # key -> (state, bytes)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.enabled = True  # Off once a state turns out larger than the whole cache
+
+    @staticmethod
+    def state_bytes(state):
+        size = state.llama_state_size
+        for name in ("scores", "input_ids"):
+            size += getattr(getattr(state, name, None), "nbytes", 0)
+        return size
+
+    def size(self):
+        return self.bytes
+
+    def get(self, key):
+        entry = self.states.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.states.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, state):
+        size = self.state_bytes(state)
+        if size > self.capacity:
+            self.enabled = False
+            logger.warning(f"Prefix state of ~{size // MB} MiB does not fit the "
+                           f"{self.capacity // MB} MiB prefix cache, prefixes are not reused")
+            return
+        if key in self.states:
+            self.bytes -= self.states[key][1]
+        self.states[key] = (state, size)
+        self.states.move_to_end(key)
+        self.bytes += size
+        while self.bytes > self.capacity:
+            _, (_, evicted) = self.states.popitem(last=False)
+            self.bytes -= evicted
+
+    def __contains__(self, key):
+        return key in self.states
+
+
+class ResponseCache:
+    """Persistent LRU/TTL cache of answer analyses.
+
+    Keys are normalized (question, answer, native_lang, explanations) plus
+    `identity`, which names the model, backend and prompt version, so
+    analyses of a replaced model or prompt are never served. Hot entries
+    live in an in-memory LRU; every entry is also written to SQLite
+    so the cache survives restarts. The disk tier is trimmed by total size,
+    least recently used first, and entries older than `ttl_hours` expire.
+    """
+    def __init__(self, db_path, identity="", max_memory_entries=512, max_disk_mb=64, ttl_hours=24 * 30):
+        self.db_path = db_path
+        self.identity = identity
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_mb * MB
+        self.ttl = ttl_hours * 3600
+        self.memory = OrderedDict()  # key -> (response, created)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _normalize(text):
+        text = re.sub(r"\s+", " ", (text or "").strip().lower())
+        return text.strip(" .,!?;:")
+
+    def make_key(self, question, answer, native_lang, explanations, mode="text"):
+        payload = json.dumps([self.identity, self._normalize(question), self._normalize(answer),
+                              native_lang, sorted(explanations or []), mode], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.memory.pop(key, None)
+
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute("SELECT response, created FROM analysis_cache WHERE key = ?",
+                               (key,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                conn.execute("UPDATE analysis_cache SET last_used = ? WHERE key = ?", (now, key))
+            elif row:
+                conn.execute("DELETE FROM analysis_cache WHERE key = ?", (key,))
+                row = None
+            conn.commit()
+            conn.close()
+
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, row[0], row[1])
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            self._remember(key, response, now)
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("INSERT OR REPLACE INTO analysis_cache VALUES (?, ?, ?, ?, ?)",
+                         (key, response, size, now, now))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM analysis_cache").fetchone()[0]
+            if total > self.max_disk_bytes:
+                rows = conn.execute("SELECT key, size FROM analysis_cache ORDER BY last_used").fetchall()
+                evicted = []
+                for old_key, old_size in rows:
+                    if total <= self.max_disk_bytes:
+                        break
+                    evicted.append((old_key,))
+                    total -= old_size
+                conn.executemany("DELETE FROM analysis_cache WHERE key = ?", evicted)
+            conn.commit()
+            conn.close()
+
+    def _remember(self, key, response, created):
+        self.memory[key] = (response, created)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+            "memory_entries": len(self.memory),
+        }
+
+
+class InferenceBusy(Exception):
+    """Raised when the inference queue is full."""
+
+
+class InferenceCancelled(Exception):
+    """Raised when the client went away before its job finished."""
+
+
+class InferenceProcessDied(RuntimeError):
+    """Raised when the worker process running a job exits or is killed."""
+
+
+class InferenceJob:
+    def __init__(self, method, args, kwargs, loop):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.loop = loop
+        self.future = loop.create_future()
+        self.cancelled = threading.Event()
+        self.started = False
+        self.tokens = None  # asyncio.Queue for streaming jobs
+
+    @property
+    def is_stream(self):
+        return self.tokens is not None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def _resolve(self, result, error):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(result)
+
+    def resolve(self, result=None, error=None):
+        """Thread-safe: hands the outcome back to the event loop."""
+        self.loop.call_soon_threadsafe(self._resolve, result, error)
+        if self.is_stream:
+            self.push(None)
+
+    def push(self, token):
+        """Thread-safe: passes one streamed token (None marks the end)."""
+        self.loop.call_soon_threadsafe(self.tokens.put_nowait, token)
+
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+_STOP_PRIORITY = -1
+
+
+class InferenceWorker:
+    """Schedules blocking EnglishAssistant calls onto inference slots.
+
+    Handlers await submit()/stream(); jobs wait in a bounded queue, time out
+    after `timeout` seconds and are cancelled between tokens when the HTTP
+    client disconnects, so the event loop itself never runs llama.cpp.
+
+    Each slot is a thread with its own llama context (replica) over the same
+    mmap'd weights, and all slots pull from the shared queue, so up to
+    `max_batch_size` sequences decode concurrently and a finished sequence
+    immediately makes room for the next one. Slots beyond the first are
+    opened on demand: when a job has waited `max_wait_ms` while every slot
+    was busy, another replica is loaded through `assistant_factory`.
+    """
+    def __init__(self, assistant, max_queue=16, timeout=120, disconnect_poll=0.5,
+                 assistant_factory=None, max_batch_size=1, max_wait_ms=50):
+        self.assistant = assistant
+        self.assistant_factory = assistant_factory
+        self.max_batch_size = max_batch_size if assistant_factory else 1
+        self.max_wait = max_wait_ms / 1000
+        self.jobs = queue.PriorityQueue(maxsize=max_queue)  # (priority, seq, job)
+        self._seq = itertools.count()
+        self.timeout = timeout
+        self.disconnect_poll = disconnect_poll
+        self.is_running = False
+        self.slots = []  # threads
+        self.busy = 0
+        self._extra_assistants = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self._add_slot(self.assistant)
+
+    def stop(self):
+        self.is_running = False
+        for _ in self.slots:
+            self.jobs.put((_STOP_PRIORITY, next(self._seq), None))
+        for thread in self.slots:
+            thread.join()
+        for assistant in self._extra_assistants:
+            assistant.close()
+
+    def _add_slot(self, assistant=None):
+        index = len(self.slots)
+        thread = threading.Thread(target=self._run, args=(assistant, index),
+                                  name=f"inference-slot-{index}", daemon=True)
+        self.slots.append(thread)
+        thread.start()
+
+    def _maybe_grow(self, job):
+        """Opens another slot if the job is still waiting and every slot is busy."""
+        if not self.is_running or job.started or job.cancelled.is_set():
+            return
+        with self._lock:
+            if len(self.slots) >= self.max_batch_size:
+                return
+            grow = self.busy >= len(self.slots)
+            if grow:
+                self._add_slot()
+        if grow:
+            logger.info(f"Inference: opening slot {len(self.slots) - 1} "
+                        f"(queued {self.jobs.qsize()}, max {self.max_batch_size})")
+        # Still waiting: look again after another max_wait
+        job.loop.call_later(self.max_wait, self._maybe_grow, job)
+
+    def _run(self, assistant, index):
+        if assistant is None:
+            try:
+                assistant = self.assistant_factory(index)
+                self._extra_assistants.append(assistant)
+            except Exception as e:
+                logger.error(f"Inference slot {index} could not load a model: {e}")
+                with self._lock:
+                    self.slots.remove(threading.current_thread())
+                    self.max_batch_size = len(self.slots)
+                return
+        while self.is_running:
+            _, _, job = self.jobs.get()
+            if job is None:
+                break
+            if job.cancelled.is_set():
+                continue
+            job.started = True
+            with self._lock:
+                self.busy += 1
+            alive = True
+            try:
+                method = getattr(assistant, job.method)
+                result = method(*job.args, should_stop=job.cancelled.is_set, **job.kwargs)
+                if job.is_stream:
+                    for token in result:
+                        job.push(token)
+                    result = None
+            except InferenceProcessDied as e:
+                # Only the job in flight is lost; the slot gets a fresh process
+                logger.error(f"Inference job {job.method} failed: {e}")
+                job.resolve(error=e)
+                alive = self._restart_slot(assistant, index)
+            except Exception as e:
+                logger.error(f"Inference job {job.method} failed: {e}")
+                job.resolve(error=e)
+            else:
+                job.resolve(result)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+            if not alive:
+                return
+
+    def _restart_slot(self, assistant, index):
+        """Restarts the process behind a slot, or drops the slot if that fails."""
+        try:
+            assistant.restart()
+        except Exception as e:
+            logger.error(f"Inference slot {index} dropped, its process could not be restarted: {e}")
+            with self._lock:
+                self.slots.remove(threading.current_thread())
+                self.max_batch_size = len(self.slots)
+            return False
+        return True
+
+    def _enqueue(self, job, priority):
+        if self.is_running and not self.slots:
+            raise InferenceBusy("No inference slot is running")
+        try:
+            self.jobs.put_nowait((priority, next(self._seq), job))
+        except queue.Full:
+            raise InferenceBusy(f"Inference queue is full ({self.jobs.maxsize} jobs)")
+        if len(self.slots) < self.max_batch_size:
+            job.loop.call_later(self.max_wait, self._maybe_grow, job)
+
+    async def submit(self, method, *args, request=None, timeout=None,
+                     priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Queues assistant.<method>(*args, **kwargs) and awaits its result.
+
+        Background work (e.g. prefetching) passes PRIORITY_BACKGROUND so it
+        never delays a learner who is waiting.
+        """
+        job = InferenceJob(method, args, kwargs, asyncio.get_running_loop())
+        self._enqueue(job, priority)
+        try:
+            return await asyncio.wait_for(self._wait(job, request), timeout or self.timeout)
+        except BaseException:
+            # Timeout, disconnect or task cancellation: let the worker skip or abort it
+            job.cancel()
+            raise
+
+    async def stream(self, method, *args, request=None, timeout=None,
+                     priority=PRIORITY_INTERACTIVE, **kwargs):
+        """Queues a generator method and yields its tokens as they are produced."""
+        loop = asyncio.get_running_loop()
+        job = InferenceJob(method, args, kwargs, loop)
+        job.tokens = asyncio.Queue()
+        self._enqueue(job, priority)
+        deadline = loop.time() + (timeout or self.timeout)
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    token = await asyncio.wait_for(job.tokens.get(),
+                                                   min(self.disconnect_poll, remaining))
+                except asyncio.TimeoutError:
+                    if request is not None and await request.is_disconnected():
+                        raise InferenceCancelled("Client disconnected")
+                    continue
+                if token is None:
+                    break
+                yield token
+            if job.future.exception():
+                raise job.future.exception()
+        finally:
+            job.cancel()
+
+    async def _wait(self, job, request):
+        while True:
+            done, _ = await asyncio.wait({job.future}, timeout=self.disconnect_poll)
+            if done:
+                return job.future.result()
+            if request is not None and await request.is_disconnected():
+                raise InferenceCancelled("Client disconnected")
+
+    def stats(self):
+        return {
+            "queued": self.jobs.qsize(),
+            "max_queue": self.jobs.maxsize,
+            "slots": len(self.slots),
+            "busy": self.busy,
+            "max_batch_size": self.max_batch_size,
+            "restarts": sum(getattr(assistant, "restarts", 0) for assistant in self._extra_assistants),
+        }
+
+
+def _serve_assistant(conn, cancel, factory):
+    """Worker process: builds one assistant and runs the calls sent over conn."""
+    try:
+        assistant = factory()
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+    while True:
+        message = conn.recv()
+        if message[0] == "stop":
+            break
+        _, method, args, kwargs = message
+        cancel.clear()
+        try:
+            result = getattr(assistant, method)(*args, should_stop=cancel.is_set, **kwargs)
+            if inspect.isgenerator(result):
+                for token in result:
+                    conn.send(("token", token))
+                conn.send(("end", None))
+            else:
+                conn.send(("result", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+    close = getattr(assistant, "close", None)
+    if close:
+        close()
+
+
+class RemoteAssistant:
+    """Proxy for an assistant living in its own process, talked to over a pipe.
+
+    Calls block the calling slot thread only; should_stop() is forwarded as a
+    shared event so the process aborts generation between tokens. A process
+    that crashes or is killed fails the call in flight with
+    InferenceProcessDied; restart() replaces it, and a process found dead
+    between calls is replaced before the next one.
+    """
+    def __init__(self, factory, index=0, poll_interval=0.05):
+        self.factory = factory
+        self.index = index
+        self.poll_interval = poll_interval
+        self.restarts = 0
+        self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.cancel = context.Event()
+        self.process = context.Process(target=_serve_assistant,
+                                       args=(child_conn, self.cancel, self.factory),
+                                       name=f"inference-process-{self.index}",
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()  # Only the child holds it, so its death shows up as EOF here
+        try:
+            kind, payload = self.conn.recv()
+        except EOFError:
+            kind, payload = "error", f"exit code {self.process.exitcode}"
+        if kind == "error":
+            self.process.join()
+            raise RuntimeError(f"Inference process {self.index} failed to start: {payload}")
+        logger.info(f"Inference process {self.index} ready (pid {self.process.pid})")
+
+    def restart(self):
+        logger.warning(f"Inference process {self.index} (pid {self.process.pid}) exited "
+                       f"with code {self.process.exitcode}, starting a new one")
+        self.conn.close()
+        self.process.join(timeout=10)
+        self._start()
+        self.restarts += 1
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        def call(*args, should_stop=None, **kwargs):
+            return self._call(method, args, kwargs, should_stop)
+        return call
+
+    def _died(self):
+        self.process.join(timeout=1)
+        return InferenceProcessDied(f"Inference process {self.index} (pid {self.process.pid}) "
+                                    f"died with exit code {self.process.exitcode}")
+
+    def _recv(self, should_stop):
+        try:
+            while not self.conn.poll(self.poll_interval):
+                if not self.process.is_alive():
+                    raise self._died()
+                if should_stop and should_stop():
+                    self.cancel.set()
+            return self.conn.recv()
+        except (EOFError, OSError):
+            raise self._died()
+
+    def _call(self, method, args, kwargs, should_stop):
+        if not self.process.is_alive():
+            try:
+                self.restart()
+            except RuntimeError as e:
+                raise InferenceProcessDied(str(e))
+        try:
+            self.conn.send(("call", method, args, kwargs))
+        except OSError:  # BrokenPipeError: it died after the check
+            raise self._died()
+        kind, payload = self._recv(should_stop)
+        if kind == "error":
+            raise RuntimeError(payload)
+        if kind == "result":
+            return payload
+        return self._tokens(kind, payload, should_stop)
+
+    def _tokens(self, kind, payload, should_stop):
+        # Always drained up to "end", so the pipe is clean for the next call
+        while kind == "token":
+            yield payload
+            kind, payload = self._recv(should_stop)
+        if kind == "error":
+            raise RuntimeError(payload)
+
+    def close(self):
+        if self.process.is_alive():
+            try:
+                self.conn.send(("stop",))
+            except OSError:
+                pass
+            self.process.join(timeout=10)
+
+
+class InferencePool(InferenceWorker):
+    """InferenceWorker whose slots are separate worker processes.
+
+    Every process builds its assistant with `assistant_factory` (a picklable
+    callable) and opens the same GGUF with mmap, so the weight pages are
+    shared through the page cache and only the KV caches are per process.
+    Throughput then scales across cores instead of being limited to one
+    llama.cpp context and one interpreter.
+    """
+    def __init__(self, assistant_factory, processes=2, **kwargs):
+        self.process_factory = assistant_factory
+        super().__init__(None,
+                         assistant_factory=lambda index: RemoteAssistant(self.process_factory, index),
+                         max_batch_size=processes,
+                         **kwargs)
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        for _ in range(self.max_batch_size):
+            self._add_slot()
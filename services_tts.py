@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import threading
+import time
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.package
+
+from logger_config import logger
+
+
+def model_fingerprint(model_path):
+    """Identifies a model file cheaply: a replaced model gets new cache keys."""
+    path = Path(model_path)
+    if not path.exists():
+        return path.name
+    stat = path.stat()
+    return f"{path.name}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def to_int16(audio):
+    """Silero returns float samples in [-1, 1]; the cache stores int16."""
+    samples = audio.numpy() if hasattr(audio, "numpy") else np.asarray(audio)
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+def split_sentences(text, max_chars=200):
+    """Splits text into sentence- or clause-sized pieces for pipelined synthesis.
+
+    Pieces end at . ! ? ; : or a line break; longer ones are split again at
+    commas, so the first audio is ready quickly and fixed prefixes such as
+    "переведи на английский следующую фразу:" are cached on their own.
+    """
+    pieces = []
+    for sentence in re.split(r"(?<=[.!?;:…])\s+|\n+", text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(",", 0, max_chars) + 1 or sentence.rfind(" ", 0, max_chars) + 1 or max_chars
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def wav_bytes(samples, sample_rate):
+    """int16 mono samples as a WAV file in memory."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(sample_rate)
+        writer.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def wav_frame(data):
+    """Length-prefixed frame for streaming several WAV files in one response."""
+    return struct.pack(">I", len(data)) + data
+
+
+class WaveformCache:
+    """Synthesized speech keyed by hash(text, speaker, sample_rate, model).
+
+    A bounded in-memory LRU of int16 arrays sits in front of a directory of
+    int16 mono WAV files, which survives restarts and is shared by all
+    processes using the same directory. The disk tier is trimmed by last
+    use once it grows past `max_disk_mb`.
+    """
+    def __init__(self, cache_dir, model_path, max_memory_mb=64, max_disk_mb=1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_id = model_fingerprint(model_path)
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self._memory = OrderedDict()  # key -> (samples, sample_rate)
+        self._memory_bytes = 0
+        self._disk_bytes = sum(p.stat().st_size for p in self.cache_dir.glob("*/*.wav"))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text, speaker, sample_rate):
+        payload = json.dumps([self.model_id, speaker, sample_rate, text], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.wav"
+
+    def __contains__(self, key):
+        return key in self._memory or self.path(key).exists()
+
+    def get(self, key):
+        """Returns (int16 samples, sample_rate) or None."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry
+        path = self.path(key)
+        try:
+            with wave.open(str(path), "rb") as reader:
+                sample_rate = reader.getframerate()
+                samples = np.frombuffer(reader.readframes(reader.getnframes()), dtype=np.int16)
+            os.utime(path)  # Last use, for disk eviction
+        except (FileNotFoundError, wave.Error, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, samples, sample_rate)
+        return samples, sample_rate
+
+    def put(self, key, samples, sample_rate):
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with wave.open(str(tmp), "wb") as writer:
+            writer.setnchannels(1)
+            writer.setsampwidth(2)
+            writer.setframerate(sample_rate)
+            writer.writeframes(samples.tobytes())
+        os.replace(tmp, path)  # Atomic, so readers never see a partial file
+        with self._lock:
+            self._remember(key, samples, sample_rate)
+            self._disk_bytes += path.stat().st_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._trim_disk()
+
+    def _remember(self, key, samples, sample_rate):
+        if key in self._memory:
+            return
+        self._memory[key] = (samples, sample_rate)
+        self._memory_bytes += samples.nbytes
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            _, (evicted, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted.nbytes
+
+    def _trim_disk(self):
+        files = sorted(self.cache_dir.glob("*/*.wav"), key=lambda p: p.stat().st_mtime)
+        target = self.max_disk_bytes * 0.9
+        total = sum(p.stat().st_size for p in files)
+        for path in files:
+            if total <= target:
+                break
+            size = path.stat().st_size
+            path.unlink(missing_ok=True)
+            total -= size
+        self._disk_bytes = total
+        logger.info(f"TTS cache trimmed to {total / 1024 / 1024:.0f} MB")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "memory_mb": round(self._memory_bytes / 1024 / 1024, 1),
+                "disk_mb": round(self._disk_bytes / 1024 / 1024, 1),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+def load_tts_model(model_path):
+    model = torch.package.PackageImporter(str(model_path)).load_pickle("tts_models", "model")
+    model.to(torch.device('cpu'))
+    return model
+
+
+class SynthesisBusy(Exception):
+    """Raised when the synthesis queue is full."""
+
+
+class SpeechSynthesizer:
+    """Silero synthesis for all users behind a fixed pool of workers.
+
+    Each worker owns a copy of the model, so no model is ever run by two
+    threads at once (the TorchScript modules are not documented as safe for
+    that) and workers really synthesize in parallel. torch intra-op threads
+    are process-global, so the `thread_budget` is set once and split between
+    the workers instead of every player asking for its own. Requests wait in
+    per-user queues served round-robin, so a long text from one learner does
+    not hold up everybody else. Cache hits never enter the queue.
+    """
+    def __init__(self, model_path, sample_rate=48000, speaker='kseniya', cache=None,
+                 workers=2, thread_budget=4, max_queue=64):
+        self.model_path = Path(model_path)
+        if not self.model_path.exists():
+            raise FileNotFoundError(f"Model file not found: {model_path}")
+        self.threads_per_worker = max(1, thread_budget // workers)
+        torch.set_num_threads(self.threads_per_worker)
+        self.models = [load_tts_model(self.model_path) for _ in range(workers)]
+        self.sample_rate = sample_rate
+        self.speaker = speaker
+        self.cache = cache
+        self.max_queue = max_queue
+        self._queues = {}  # user -> deque of (text, cache key, Future)
+        self._order = deque()  # Users with waiting requests, round-robin
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.synthesized = 0
+        self.audio_seconds = 0.0
+        self.synthesis_seconds = 0.0
+        self._threads = [threading.Thread(target=self._run, args=(model,), daemon=True, name=f"tts-{i}")
+                         for i, model in enumerate(self.models)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, text, user_id=None):
+        """Returns a concurrent Future with the int16 samples of `text`."""
+        future = Future()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(text, self.speaker, self.sample_rate)
+            cached = self.cache.get(key)
+            if cached is not None:
+                future.set_result(cached[0])
+                return future
+        with self._cond:
+            if self._queued >= self.max_queue:
+                raise SynthesisBusy(f"{self._queued} texts already waiting for synthesis")
+            if user_id not in self._queues:
+                self._queues[user_id] = deque()
+                self._order.append(user_id)
+            self._queues[user_id].append((text, key, future))
+            self._queued += 1
+            self._cond.notify()
+        return future
+
+    async def synthesize(self, text, user_id=None):
+        return await asyncio.wrap_future(self.submit(text, user_id))
+
+    async def stream_wav(self, text, user_id=None, busy_wait=10.0):
+        """Yields one WAV per sentence of `text`. The next sentence is queued
+        while the current one is being sent, so playback can start after the
+        first sentence.
+
+        Only the first sentence raises SynthesisBusy. Later ones wait up to
+        `busy_wait` seconds for room in the queue; after that b"" is yielded
+        and the stream ends. A sentence still queued when the consumer stops
+        is cancelled, so it does not take a worker.
+        """
+        sentences = split_sentences(text)
+        pending = None
+        try:
+            for i, sentence in enumerate(sentences):
+                if pending is None:
+                    if i == 0:
+                        pending = self.submit(sentence, user_id)
+                    else:
+                        pending = await self._submit_when_free(sentence, user_id, busy_wait)
+                    if pending is None:
+                        logger.warning(f"Synthesis queue still full after {busy_wait} s, "
+                                       f"speech stopped at sentence {i + 1} of {len(sentences)}")
+                        yield b""
+                        return
+                audio = await asyncio.wrap_future(pending)
+                pending = None
+                if i + 1 < len(sentences):
+                    try:
+                        pending = self.submit(sentences[i + 1], user_id)
+                    except SynthesisBusy:
+                        pass  # Submitted with waiting on the next iteration
+                yield wav_bytes(audio, self.sample_rate)
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def _submit_when_free(self, text, user_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.submit(text, user_id)
+            except SynthesisBusy:
+                if time.monotonic() >= deadline:
+                    return None
+                await asyncio.sleep(0.1)
+
+    def _next_job(self):
+        with self._cond:
+            while not self._order and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            user_id = self._order.popleft()
+            jobs = self._queues[user_id]
+            job = jobs.popleft()
+            if jobs:
+                self._order.append(user_id)
+            else:
+                del self._queues[user_id]
+            self._queued -= 1
+            return job
+
+    def _run(self, model):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            text, key, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                started = time.perf_counter()
+                audio = to_int16(model.apply_tts(text=text,
+                                                 speaker=self.speaker,
+                                                 sample_rate=self.sample_rate))
+                elapsed = time.perf_counter() - started
+                with self._cond:
+                    self.synthesized += 1
+                    self.synthesis_seconds += elapsed
+                    self.audio_seconds += len(audio) / self.sample_rate
+                if key is not None:
+                    self.cache.put(key, audio, self.sample_rate)
+                future.set_result(audio)
+            except Exception as e:
+                logger.error(f"Synthesis error: {e}")
+                future.set_exception(e)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": self._queued,
+                "users_waiting": len(self._order),
+                "max_queue": self.max_queue,
+                "workers": len(self._threads),
+                "threads_per_worker": self.threads_per_worker,
+                "synthesized": self.synthesized,
+                # Synthesis time per second of audio; below 1 is faster than real time
+                "rtf": round(self.synthesis_seconds / self.audio_seconds, 3) if self.audio_seconds else None,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
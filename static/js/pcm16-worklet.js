@@ -0,0 +1,54 @@
+// Converts microphone audio to 16 kHz mono PCM16 and posts it in ~100 ms chunks
+// for /ws/recognize. Posting 'flush' to the port sends the partly filled chunk
+// with last=true, so the page knows it can send the stop action.
+class Pcm16CaptureProcessor extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        const opts = options.processorOptions || {};
+        this.targetRate = opts.targetRate || 16000;
+        this.chunkSamples = opts.chunkSamples || this.targetRate / 10;
+        this.ratio = sampleRate / this.targetRate;
+        this.position = 0; // Fractional read position inside the current input block
+        this.chunk = new Int16Array(this.chunkSamples);
+        this.filled = 0;
+        this.port.onmessage = (event) => {
+            if (event.data === 'flush') {
+                this.post(this.chunk.slice(0, this.filled), true);
+                this.filled = 0;
+            }
+        };
+    }
+
+    post(samples, last) {
+        this.port.postMessage({pcm: samples.buffer, last: last}, [samples.buffer]);
+    }
+
+    process(inputs) {
+        const input = inputs[0];
+        if (!input || input.length === 0) {
+            return true;
+        }
+        const channel = input[0];
+        while (this.position < channel.length) {
+            // Average the input samples that fall into one output sample
+            const start = Math.floor(this.position);
+            const end = Math.max(start + 1, Math.min(channel.length, Math.floor(this.position + this.ratio)));
+            let sum = 0;
+            for (let i = start; i < end; i++) {
+                sum += channel[i];
+            }
+            const sample = Math.max(-1, Math.min(1, sum / (end - start)));
+            this.chunk[this.filled++] = sample < 0 ? sample * 0x8000 : sample * 0x7fff;
+            if (this.filled === this.chunkSamples) {
+                this.post(this.chunk, false);
+                this.chunk = new Int16Array(this.chunkSamples);
+                this.filled = 0;
+            }
+            this.position += this.ratio;
+        }
+        this.position -= channel.length;
+        return true;
+    }
+}
+
+registerProcessor('pcm16-capture', Pcm16CaptureProcessor);
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import signal
+import time
+
+import pytest
+
+pytest.importorskip("llama_cpp")
+
+from services_inference import InferencePool, InferenceProcessDied
+
+
+class PidAssistant:
+    """Picklable stand-in for EnglishAssistant that reports its process."""
+    def pid(self, should_stop=None):
+        return os.getpid()
+
+    def wait(self, seconds, should_stop=None):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not (should_stop and should_stop()):
+            time.sleep(0.01)
+        return os.getpid()
+
+
+def run_with_pool(scenario):
+    async def main():
+        pool = InferencePool(PidAssistant, processes=1, timeout=60)
+        pool.start()
+        try:
+            await scenario(pool)
+        finally:
+            pool.stop()
+    asyncio.run(main())
+
+
+def test_killed_idle_process_is_replaced():
+    async def scenario(pool):
+        first = await pool.submit("pid")
+        os.kill(first, signal.SIGKILL)
+        time.sleep(0.2)
+        second = await pool.submit("pid")
+        assert second != first
+        stats = pool.stats()
+        assert stats["slots"] == 1 and stats["busy"] == 0 and stats["restarts"] == 1
+    run_with_pool(scenario)
+
+
+def test_killed_busy_process_fails_only_its_job():
+    async def scenario(pool):
+        first = await pool.submit("pid")
+        job = asyncio.ensure_future(pool.submit("wait", 30))
+        await asyncio.sleep(0.5)
+        os.kill(first, signal.SIGKILL)
+        with pytest.raises(InferenceProcessDied):
+            await job
+        second = await pool.submit("pid")
+        assert second != first
+        assert pool.stats()["restarts"] == 1
+    run_with_pool(scenario)
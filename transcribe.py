@@ -0,0 +1,70 @@
+"""Transcribes recorded learner answers offline, with word-level timings.
+
+Every WAV/FLAC file is streamed through KaldiRecognizer in chunks, so long
+recordings are never held in memory. Results are written as JSON lines, one
+per file; a file that fails gets an "error" field instead of a transcript.
+
+    python transcribe.py answers/ --workers 4 --output transcripts.jsonl
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from vosk import Model
+
+from logger_config import logger
+from services_audio import transcribe_file
+from services_batch import default_workers, process_map
+
+MODEL_SPEECH_RECOGNIZER = "../models/vosk-model-small-en-us-zamia-0.5"
+AUDIO_SUFFIXES = (".wav", ".flac")
+
+def _load_model(model_path):
+    return Model(str(model_path))
+
+def _transcribe(model, path):
+    try:
+        return transcribe_file(model, path)
+    except Exception as e:
+        return {"file": Path(path).name, "error": str(e)}
+
+def collect_files(paths):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*") if p.suffix.lower() in AUDIO_SUFFIXES))
+        else:
+            files.append(path)
+    return [str(path) for path in files]
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe WAV/FLAC recordings with word timings")
+    parser.add_argument("paths", nargs="+", help="audio files or directories")
+    parser.add_argument("--model", default=MODEL_SPEECH_RECOGNIZER)
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="processes, each with its own Vosk model (default: one per core)")
+    parser.add_argument("--output", help="JSON lines file (default: stdout)")
+    args = parser.parse_args()
+
+    files = collect_files(args.paths)
+    if not files:
+        logger.info("No audio files found.")
+        return
+
+    workers = max(1, min(args.workers, len(files)))
+    logger.info(f"Transcribing {len(files)} files with {workers} workers")
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for result in process_map(_transcribe, files, _load_model, (args.model,),
+                                  workers=workers, progress="files transcribed"):
+            output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            output.flush()
+            if "error" in result:
+                logger.error(f"{result['file']}: {result['error']}")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+if __name__ == "__main__":
+    main()